@@ -0,0 +1,85 @@
+"""
+Description: Load test of request coalescing: bursts of concurrent callers against a cold snapshot
+(GET /) and against a single server (GET /servers/{name}), counting the calls reaching the fake Docker
+daemon and the pings reaching the fake Minecraft servers
+
+With coalescing those counts stay flat as concurrency grows; the "direct" rows bypass the single-flight
+layer for comparison. GET / makes no Docker calls, its containers come from the (event-driven) inventory.
+
+Run from the repository root: python bench/bench_coalesce.py [--concurrency 1 10 100 1000]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import docker  # noqa: E402
+import httpx  # noqa: E402
+
+from fakes import FakeDockerClient, FakeMinecraftServer  # noqa: E402
+
+
+async def burst(fn, concurrency: int) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(fn() for _ in range(concurrency)))
+    return time.perf_counter() - start
+
+
+async def run(args):
+    servers = [FakeMinecraftServer(args.latency) for _ in range(args.servers)]
+    ports = [await x.start() for x in servers]
+    fake = FakeDockerClient.with_servers(ports, round_trip=args.docker_round_trip)
+    docker.from_env = lambda *a, **kw: fake  # type: ignore
+    import main  # noqa: E402 - picks up the fake client
+    from scheduler import ProbeScheduler  # noqa: E402
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await main.poller.stop()  # Only the bursts may refresh
+
+        async def index():
+            (await client.get("/")).raise_for_status()
+
+        async def index_direct():
+            await main.poller._refresh()
+
+        async def single():
+            (await client.get("/servers/server-0")).raise_for_status()
+
+        async def single_direct():
+            await main.lookup_server("server-0")
+
+        print(f"{'endpoint':<18} {'mode':<9} {'callers':>7} {'docker calls':>12} {'pings':>7} {'time (ms)':>9}")
+        for endpoint, coalesced, direct in (("GET /", index, index_direct), ("GET /servers/{n}", single, single_direct)):
+            for concurrency in args.concurrency:
+                for mode, fn in (("coalesced", coalesced), ("direct", direct)):
+                    # Start cold every time: no snapshot, and every server due for a ping
+                    main.poller.snapshot = None
+                    main.poller.scheduler = ProbeScheduler()
+                    fake.api.calls = 0
+                    for server in servers:
+                        server.pings = 0
+                    elapsed = await burst(fn, concurrency)
+                    pings = sum(x.pings for x in servers)
+                    print(f"{endpoint:<18} {mode:<9} {concurrency:>7} {fake.api.calls:>12} {pings:>7} {elapsed * 1000:>9.1f}")
+
+    for server in servers:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100, 1000], help="concurrent callers per burst")
+    parser.add_argument("--servers", type=int, default=10, help="servers listed by the fake Docker daemon")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds each fake server waits before answering")
+    parser.add_argument("--docker-round-trip", type=float, default=0.0005, help="seconds per fake Docker API call")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
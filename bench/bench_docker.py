@@ -0,0 +1,50 @@
+"""
+Description: Benchmark of listing the host's server containers, with full vs sparse Docker listings
+
+The fake Docker API from fakes.py stands in for the daemon.
+
+Run from the repository root: python bench/bench_docker.py
+"""
+
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from common import is_server_container, list_containers  # noqa: E402
+from fakes import FakeDockerClient  # noqa: E402
+from fixtures import container_attrs  # noqa: E402
+
+
+def full_listing(client) -> list:
+    """list_containers as it was before sparse listings"""
+    return list(filter(is_server_container, client.containers.list(all=True)))
+
+
+def unrelated(i: int) -> dict:
+    attrs = copy.deepcopy(container_attrs(i, 0))
+    attrs["Config"]["Image"] = f"ghcr.io/example/service-{i}:latest"
+    attrs["Config"]["Labels"] = {"com.example.service": str(i)}
+    return attrs
+
+
+def main():
+    print(f"{'servers':>8} {'others':>7} {'calls (full)':>13} {'calls (sparse)':>15} {'full (ms)':>10} {'sparse (ms)':>12}")
+    for servers, others in [(5, 0), (5, 50), (20, 50), (5, 200), (50, 200)]:
+        inspected = [container_attrs(i, 25565 + i) for i in range(servers)] + [unrelated(servers + i) for i in range(others)]
+        results = []
+        for lister in (full_listing, list_containers):
+            client = FakeDockerClient(inspected)
+            start = time.perf_counter()
+            found = lister(client)  # type: ignore
+            results.append((client.api.calls, time.perf_counter() - start, sorted(x.id for x in found)))
+        (full_calls, full_time, full_ids), (sparse_calls, sparse_time, sparse_ids) = results
+        assert full_ids == sparse_ids and len(full_ids) == servers
+        print(f"{servers:>8} {others:>7} {full_calls:>13} {sparse_calls:>15} {full_time * 1000:>10.1f} {sparse_time * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Description: Benchmark of the asyncio EngineClient against docker-py, both talking to a fake daemon socket
+
+Times, per fleet size, a full listing and a burst of concurrent single lookups, docker-py going through
+threads as the service does, and counts the connections each client opened to the daemon. That both
+clients see the same containers is checked by tests/test_engine.py.
+
+Run from the repository root: python bench/bench_engine.py [--servers 100 1000]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from docker import DockerClient  # noqa: E402
+
+from common import get_container, get_container_async, list_containers, list_containers_async  # noqa: E402
+from engine import EngineClient  # noqa: E402
+from fakes import FakeEngine  # noqa: E402
+from fixtures import container_attrs  # noqa: E402
+
+POOL_SIZE = 10
+
+
+def fleet(count: int) -> list:
+    """count servers, one of which is hidden and a tenth of which are stopped, plus as many unrelated containers"""
+    inspected = [container_attrs(i, 25565 + i, running=i % 10 != 9) for i in range(count)]
+    inspected[0]["Config"]["Labels"]["net.forgeserv.hidden"] = "true"
+    for i in range(count, 2 * count):
+        attrs = container_attrs(i, 0)
+        attrs["Config"]["Image"] = f"ghcr.io/example/service-{i}:latest"
+        inspected.append(attrs)
+    return inspected
+
+
+async def measure(base_url: str, fake: FakeEngine, count: int, lookups: int):
+    names = [f"server-{i % count}" for i in range(lookups)]
+    rows = []
+
+    fake.connections = 0
+    client = DockerClient(base_url=base_url, max_pool_size=POOL_SIZE)
+    connections = fake.connections  # The version check
+    start = time.perf_counter()
+    await asyncio.to_thread(list_containers, client, True)
+    listed = time.perf_counter()
+    await asyncio.gather(*(asyncio.to_thread(get_container, client, x) for x in names))
+    rows.append(("docker-py", listed - start, time.perf_counter() - listed, fake.connections - connections))
+    client.close()
+
+    fake.connections = 0
+    engine = EngineClient(fake.path, pool_size=POOL_SIZE)
+    start = time.perf_counter()
+    await list_containers_async(engine, True)
+    listed = time.perf_counter()
+    await asyncio.gather(*(get_container_async(engine, x) for x in names))
+    rows.append(("engine", listed - start, time.perf_counter() - listed, fake.connections))
+    engine.close()
+
+    for label, list_time, lookup_time, connections in rows:
+        print(f"{count:>7} {label:<10} {list_time * 1000:>9.1f} {lookups:>7} {lookup_time * 1000:>11.1f} {connections:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", type=int, nargs="+", default=[100, 1000], help="fleet sizes to benchmark")
+    parser.add_argument("--lookups", type=int, default=500, help="concurrent single container lookups")
+    parser.add_argument("--round-trip", type=float, default=0.0005, help="seconds the fake daemon takes per call")
+    args = parser.parse_args()
+
+    print(f"{'servers':>7} {'client':<10} {'list (ms)':>9} {'lookups':>7} {'lookup (ms)':>11} {'connections':>11}")
+    for count in args.servers:
+        fake = FakeEngine(fleet(count), args.round_trip)
+        base_url = fake.start(os.path.join(tempfile.mkdtemp(), "docker.sock"))
+        asyncio.run(measure(base_url, fake, count, args.lookups))
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Description: Benchmark of GET / against a fake Docker daemon listing N synthetic servers, all answering
+pings from local fake Minecraft servers
+
+Reports the time to build a snapshot (a full refresh, pinging every server), and the requests/sec and
+latency percentiles of GET / under concurrent load.
+
+Run from the repository root: python bench/bench_index.py [--servers 1 10 100 1000] [--latency 0.02]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import docker  # noqa: E402
+import httpx  # noqa: E402
+
+from fakes import FAILURE_MODES, HEALTHY, FakeDockerClient, FakeMinecraftServer  # noqa: E402
+
+
+def percentile(samples: list, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def load(client: httpx.AsyncClient, path: str, requests: int, concurrency: int) -> list:
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await client.get(path)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def run(args, count: int):
+    healthy = max(1, round(count * (1 - args.failure_rate)))
+    servers = [FakeMinecraftServer(args.latency, args.favicon_size, args.players) for _ in range(min(healthy, args.listeners))]
+    servers += [FakeMinecraftServer(args.latency, failure=args.failure) for _ in range(1 if healthy < count else 0)]
+    ports = [await x.start() for x in servers]
+    # Servers share the fake listeners, since 1000 ports would run into the open files limit
+    assigned = [ports[i % min(healthy, args.listeners)] for i in range(healthy)] + [ports[-1]] * (count - healthy)
+
+    fake = FakeDockerClient.with_servers(assigned, round_trip=args.docker_round_trip)
+    docker.from_env = lambda *a, **kw: fake  # type: ignore
+    import main  # noqa: E402 - picks up the fake client
+
+    async with main.lifespan(main.app):
+        start = time.perf_counter()
+        snapshot = await main.poller.refresh()
+        refresh = time.perf_counter() - start
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await load(client, "/" + args.query, 10, 1)  # warm up
+            start = time.perf_counter()
+            latencies = await load(client, "/" + args.query, args.requests, args.concurrency)
+            elapsed = time.perf_counter() - start
+
+    for server in servers:
+        await server.stop()
+    del sys.modules["main"]
+
+    print(
+        f"{count:>7} {len(snapshot.servers):>7} {refresh * 1000:>12.1f} {args.requests / elapsed:>9.0f} "
+        f"{statistics.median(latencies) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", type=int, nargs="+", default=[1, 10, 100, 1000], help="fleet sizes to benchmark")
+    parser.add_argument("--requests", type=int, default=500, help="requests per fleet size")
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrent clients")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds each fake server waits before answering")
+    parser.add_argument("--favicon-size", type=int, default=4096, help="bytes of favicon in each status response")
+    parser.add_argument("--players", type=int, default=12, help="player samples in each status response")
+    parser.add_argument("--failure", choices=FAILURE_MODES, default=HEALTHY, help="how the failing servers misbehave")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of servers which fail")
+    parser.add_argument("--listeners", type=int, default=50, help="fake Minecraft servers to spread the fleet over")
+    parser.add_argument("--query", default="", help="query string of the requests, i.e. ?fields=name,online")
+    parser.add_argument("--docker-round-trip", type=float, default=0.0005, help="seconds per fake Docker API call")
+    args = parser.parse_args()
+
+    print(f"{'servers':>7} {'listed':>7} {'refresh (ms)':>12} {'req/s':>9} {'p50 (ms)':>8} {'p99 (ms)':>8}")
+    for count in args.servers:
+        asyncio.run(run(args, count))
+
+
+if __name__ == "__main__":
+    main()
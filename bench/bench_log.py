@@ -0,0 +1,65 @@
+"""
+Description: Benchmark of health check log parsing against the previous findall / index / recursive MOTD cleanup
+
+Run from the repository root: python bench/bench_log.py
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from server import LogDerivedInfo, Server  # noqa: E402
+
+SPECIAL_CHAR = "§"
+NUMBER = 2000
+
+
+def legacy_parse_log_for_info(logs: str):
+    def __cleanup_motd(motd: str) -> str:
+        if SPECIAL_CHAR not in motd:
+            return motd
+        start = motd.index(SPECIAL_CHAR)
+        repl = motd[start : start + 2]
+        return __cleanup_motd(motd.replace(repl, ""))
+
+    _, logs = logs.split(" : ")
+    keys = re.findall(r"\w+(?=\=)", logs)
+    ret = {"version": "", "online": 0, "max": 0, "motd": ""}
+    for idx, key in enumerate(keys):
+        start = logs.index(key) + len(f"{key}=")
+        end = len(logs) - 1
+        if key != keys[-1]:
+            end = logs.index(keys[idx + 1])
+        value = logs[start:end].strip()
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+        ret[key] = value
+    ret["motd"] = __cleanup_motd(ret["motd"]).replace('"', "").replace("'", "")
+    return LogDerivedInfo(**ret)
+
+
+def health_output(words: int) -> str:
+    codes = "0123456789abcdefklmnor"
+    motd = " ".join(f"{SPECIAL_CHAR}{codes[i % len(codes)]}{SPECIAL_CHAR}lword{i}" for i in range(words))
+    return f"localhost:25565 : version=NeoForge 1.21.1 online=7 max=40 motd='{motd}'\n"
+
+
+def main():
+    uncached = Server.parse_log_for_info.__wrapped__  # type: ignore
+    print(f"{'motd codes':>10} {'legacy (us)':>12} {'single pass (us)':>17} {'memoized (us)':>14}")
+    for words in (0, 8, 64, 256):
+        output = health_output(words)
+        assert legacy_parse_log_for_info(output) == uncached(output), output
+        legacy = timeit.timeit(lambda: legacy_parse_log_for_info(output), number=NUMBER) / NUMBER
+        single_pass = timeit.timeit(lambda: uncached(output), number=NUMBER) / NUMBER
+        memoized = timeit.timeit(lambda: Server.parse_log_for_info(output), number=NUMBER) / NUMBER
+        print(f"{words * 2:>10} {legacy * 1e6:>12.1f} {single_pass * 1e6:>17.1f} {memoized * 1e6:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
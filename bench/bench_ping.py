@@ -0,0 +1,131 @@
+"""
+Description: Microbenchmark of the SLP status response decoders, blocking and asyncio, against the baseline
+ping() decoder (recv(1) per VarInt byte, then bytes += per chunk of the body)
+
+The response is sent one TCP segment's worth at a time from another thread, and each reader is timed by
+the CPU time its own thread spends reading the packet, so that neither the sender nor the JSON parsing,
+the same for all of them, is measured.
+
+Run from the repository root: python bench/bench_ping.py
+"""
+
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from fakes import status_response  # noqa: E402
+from ping import AsyncPacketReader, PacketReader, read_status, read_status_async  # noqa: E402
+
+ROUNDS = 20
+SEGMENT_SIZE = 1460  # Roughly one TCP segment per send, as a real server's response would arrive
+
+
+def legacy_read_packet(sock):
+    def read_var_int():
+        i = 0
+        j = 0
+        while True:
+            k = sock.recv(1)
+            if not k:
+                return 0
+            k = k[0]
+            i |= (k & 0x7F) << (j * 7)
+            j += 1
+            if j > 5:
+                raise ValueError("var_int too big")
+            if not (k & 0x80):
+                return i
+
+    read_var_int()
+    sock.recv(1)
+    length = read_var_int()
+    data = b""
+    while len(data) != length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ValueError("connection aborted")
+        data += chunk
+    return data
+
+
+def legacy_read_status(sock):
+    return json.loads(legacy_read_packet(sock))
+
+
+def send(sock, response: bytes):
+    view = memoryview(response)
+    for i in range(0, len(response), SEGMENT_SIZE):
+        sock.sendall(view[i : i + SEGMENT_SIZE])
+
+
+def time_decoder(decoder, response: bytes) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        ours, theirs = socket.socketpair()
+        sender = threading.Thread(target=send, args=(theirs, response))
+        start = time.thread_time()
+        sender.start()
+        decoder(ours)
+        best = min(best, time.thread_time() - start)
+        sender.join()
+        ours.close()
+        theirs.close()
+    return best
+
+
+async def time_decoder_async(decoder, response: bytes) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        ours, theirs = socket.socketpair()
+        reader, writer = await asyncio.open_connection(sock=ours)
+        sender = threading.Thread(target=send, args=(theirs, response))
+        start = time.thread_time()
+        sender.start()
+        await decoder(reader)
+        best = min(best, time.thread_time() - start)
+        sender.join()
+        writer.close()
+        theirs.close()
+    return best
+
+
+async def decode_async(decoder, response: bytes):
+    reader, writer = await asyncio.open_connection(sock=socket_from(response))
+    try:
+        return await decoder(reader)
+    finally:
+        writer.close()
+
+
+def main():
+    print(f"{'response':>12} {'baseline (ms cpu)':>18} {'socket (ms)':>12} {'speedup':>8} {'asyncio (ms)':>13} {'speedup':>8}")
+    for favicon_size, players in [(8 * 1024, 12), (64 * 1024, 100), (512 * 1024, 100), (4 * 1024 * 1024, 100)]:
+        response = status_response(favicon_size, players, mods=favicon_size // 256)
+        expected = legacy_read_status(socket_from(response))
+        assert read_status(socket_from(response)) == expected
+        assert asyncio.run(decode_async(read_status_async, response)) == expected
+
+        legacy = time_decoder(legacy_read_packet, response)
+        buffered = time_decoder(lambda x: PacketReader(x).read_packet(), response)
+        buffered_async = asyncio.run(time_decoder_async(lambda x: AsyncPacketReader(x).read_packet(), response))
+        print(
+            f"{len(response) // 1024:>10}KB {legacy * 1000:>18.2f} {buffered * 1000:>12.2f} {legacy / buffered:>7.1f}x"
+            f" {buffered_async * 1000:>13.2f} {legacy / buffered_async:>7.1f}x"
+        )
+
+
+def socket_from(response: bytes):
+    ours, theirs = socket.socketpair()
+    threading.Thread(target=lambda: (theirs.sendall(response), theirs.close())).start()
+    return ours
+
+
+if __name__ == "__main__":
+    main()
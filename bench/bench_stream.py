@@ -0,0 +1,122 @@
+"""
+Description: Benchmark of the response modes of the list endpoints: plain JSON (the original path),
+NDJSON streaming and compressed JSON
+
+Reports, per mode, the time to first byte and to the last byte, the bytes sent and the memory high-water
+mark (as traced by tracemalloc) of a single request. The compressed modes are measured on a cold
+compression cache, as for the first client asking after each change. GET /servers?names= pings on demand, against fake
+servers answering after increasing latencies, which is where streaming the fastest first pays off.
+
+Run from the repository root: python bench/bench_stream.py [--servers 100 1000]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import docker  # noqa: E402
+
+from fakes import FakeDockerClient, FakeMinecraftServer  # noqa: E402
+
+MODES = {
+    "json": {},
+    "ndjson": {"accept": "application/x-ndjson"},
+    "gzip": {"accept-encoding": "gzip"},
+    "br": {"accept-encoding": "br"},
+}
+
+
+async def request(app, path: str, headers: dict) -> tuple:
+    """Calls the ASGI app directly, so the first body chunk can be timed (httpx buffers whole responses)"""
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "headers": [(k.encode(), v.encode()) for k, v in headers.items()],
+        "client": ("127.0.0.1", 1),
+        "server": ("bench", 80),
+    }
+    first, size = None, 0
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if requested:
+            await asyncio.Event().wait()  # The client never disconnects
+        requested = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal first, size
+        if message["type"] == "http.response.body":
+            if first is None:
+                first = time.perf_counter()
+            size += len(message.get("body", b""))
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    return first - start, time.perf_counter() - start, size  # type: ignore
+
+
+async def measure(app, path: str, headers: dict) -> tuple:
+    tracemalloc.start()
+    ttfb, total, size = await request(app, path, headers)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ttfb, total, size, peak
+
+
+async def run(args, count: int):
+    servers = [FakeMinecraftServer(args.latency * i / count, args.favicon_size) for i in range(count)]
+    ports = [await x.start() for x in servers]
+    fake = FakeDockerClient.with_servers(ports, round_trip=args.docker_round_trip)
+    docker.from_env = lambda *a, **kw: fake  # type: ignore
+    import compression  # noqa: E402
+    import main  # noqa: E402 - picks up the fake client
+
+    names = ",".join(f"server-{i}" for i in range(count))
+    async with main.lifespan(main.app):
+        await main.poller.refresh()
+        for path in ("/?all=true", f"/servers?names={names}"):
+            await request(main.app, path, {})  # warm up, rendering every server once
+            for mode, headers in MODES.items():
+                if mode == "br" and "br" not in compression.ENCODINGS:
+                    continue  # brotli isn't installed
+                if path.startswith("/servers") and "accept-encoding" in headers:
+                    continue  # Only GET / is compressed
+                ttfb, total, size, peak = await measure(main.app, path, headers)
+                label = path.split("?")[0]
+                print(f"{count:>7} {label:<9} {mode:<7} {ttfb * 1000:>9.2f} {total * 1000:>9.2f} {size:>10} {peak / 1024:>10.0f}")
+
+    for server in servers:
+        await server.stop()
+    del sys.modules["main"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", type=int, nargs="+", default=[100, 1000], help="fleet sizes to benchmark")
+    parser.add_argument("--latency", type=float, default=0.2, help="latency of the slowest fake server, the others spread below it")
+    parser.add_argument("--favicon-size", type=int, default=4096, help="bytes of favicon in each status response")
+    parser.add_argument("--docker-round-trip", type=float, default=0.0005, help="seconds per fake Docker API call")
+    args = parser.parse_args()
+
+    print(f"{'servers':>7} {'path':<9} {'mode':<7} {'ttfb (ms)':>9} {'last (ms)':>9} {'bytes':>10} {'peak (KiB)':>10}")
+    for count in args.servers:
+        asyncio.run(run(args, count))
+
+
+if __name__ == "__main__":
+    main()
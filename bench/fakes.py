@@ -0,0 +1,279 @@
+"""
+Description: In-process stand-ins for the Docker daemon and for Minecraft servers, used by the benchmarks
+"""
+
+import asyncio
+import base64
+import json
+import os
+import queue
+import re
+import threading
+import time
+from typing import Dict, List, Union
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from docker.errors import NotFound
+from docker.models.containers import ContainerCollection
+
+from fixtures import container_attrs
+
+# Failure modes of the fake Minecraft server
+HEALTHY = "healthy"
+REFUSE = "refuse"  # Nothing listening on the port
+HANG = "hang"  # Accepts the connection, never answers
+CLOSE = "close"  # Closes the connection without answering
+BAD_VARINT = "bad_varint"  # Answers with a length which never ends
+BAD_JSON = "bad_json"  # Answers with a well framed packet which isn't JSON
+FAILURE_MODES = (HEALTHY, REFUSE, HANG, CLOSE, BAD_VARINT, BAD_JSON)
+
+
+def encode_var_int(value: int) -> bytes:
+    out = b""
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out += bytes([byte | 0x80])
+        else:
+            return out + bytes([byte])
+
+
+def status_packet(body: bytes) -> bytes:
+    packet = b"\x00" + encode_var_int(len(body)) + body
+    return encode_var_int(len(packet)) + packet
+
+
+def status_response(favicon_size: int = 4096, players: int = 12, mods: int = 0) -> bytes:
+    """Builds a full status response packet, as a (modded) server would send it"""
+    status = {
+        "version": {"name": "NeoForge 1.21.1", "protocol": 767},
+        "players": {"max": 100, "online": players, "sample": [{"id": f"{i:032x}", "name": f"Player{i}"} for i in range(players)]},
+        "description": {"text": "A modpack server"},
+        "favicon": "data:image/png;base64," + base64.b64encode(os.urandom(favicon_size)).decode(),
+        "forgeData": {"mods": [{"modId": f"mod{i}", "modmarker": "1.0.0"} for i in range(mods)]},
+    }
+    return status_packet(json.dumps(status).encode())
+
+
+class FakeMinecraftServer:
+    """A local server answering Server List Pings with a fixed response, after a configurable delay"""
+
+    def __init__(self, latency: float = 0.0, favicon_size: int = 4096, players: int = 12, mods: int = 0, failure: str = HEALTHY):
+        self.latency = latency
+        self.failure = failure
+        self.response = status_response(favicon_size, players, mods)
+        self.port = 0
+        self.pings = 0
+        self._server: Union[asyncio.AbstractServer, None] = None
+
+    async def start(self) -> int:
+        """Starts listening on a free local port, and returns that port"""
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        if self.failure == REFUSE:
+            await self.stop()  # Keep the (now closed) port, so connections to it get refused
+        return self.port
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.pings += 1
+        try:
+            await reader.read(512)  # handshake + status request
+            await asyncio.sleep(self.latency)
+            if self.failure == HANG:
+                await asyncio.sleep(3600)
+            elif self.failure == BAD_VARINT:
+                writer.write(b"\xff" * 8)
+            elif self.failure == BAD_JSON:
+                writer.write(status_packet(b"{not json" + b" " * 16))
+            elif self.failure == HEALTHY:
+                writer.write(self.response)
+            await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeEventStream:
+    def __init__(self, events: "queue.Queue[Union[dict, None]]"):
+        self._events = events
+
+    def __iter__(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        self._events.put(None)
+
+
+class FakeDockerAPI:
+    """The subset of docker.APIClient used by the service, answering from a set of container inspect records
+
+    Every call costs a fixed round trip plus a JSON encode/decode of its response, which is the
+    work docker-py does against the real daemon socket.
+    """
+
+    def __init__(self, inspected: List[dict], round_trip: float = 0.0005):
+        self.inspected: Dict[str, dict] = {x["Id"]: x for x in inspected}
+        self.round_trip = round_trip
+        self.calls = 0
+        self.events_queue: "queue.Queue[Union[dict, None]]" = queue.Queue()
+        self._lock = threading.Lock()
+
+    def _respond(self, data):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.round_trip)
+        return json.loads(json.dumps(data))
+
+    def containers(self, all=False, filters=None, **kwargs):
+        return self._respond([summary(x) for x in self.inspected.values() if all or x["State"]["Running"]])
+
+    def inspect_container(self, container):
+        for attrs in self.inspected.values():
+            if container in (attrs["Id"], attrs["Name"].lstrip("/")):
+                return self._respond(attrs)
+        raise NotFound(f"No such container: {container}")
+
+    def events(self, **kwargs):
+        return FakeEventStream(self.events_queue)
+
+
+class FakeDockerClient:
+    def __init__(self, inspected: List[dict], round_trip: float = 0.0005):
+        self.api = FakeDockerAPI(inspected, round_trip)
+        self.containers = ContainerCollection(client=self)
+
+    @staticmethod
+    def with_servers(ports: List[int], round_trip: float = 0.0005) -> "FakeDockerClient":
+        """Builds a client listing one running itzg/minecraft-server container per given host port"""
+        return FakeDockerClient([container_attrs(i, port) for i, port in enumerate(ports)], round_trip)
+
+
+class FakeEngine:
+    """A Docker daemon's unix socket, answering the Engine API calls of both docker-py and the EngineClient
+
+    It runs its own event loop in a background thread, so blocking docker-py calls can be made against it from
+    any thread. Every request costs a fixed round trip, served concurrently as the daemon does.
+    """
+
+    VERSION_PREFIX = re.compile(r"^/v[0-9.]+")
+
+    def __init__(self, inspected: List[dict], round_trip: float = 0.0005):
+        self.inspected: Dict[str, dict] = {x["Id"]: x for x in inspected}
+        self.round_trip = round_trip
+        self.requests = 0
+        self.connections = 0
+        self.path = ""
+        self._subscribers: List[asyncio.Queue] = []
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="fake-engine", daemon=True)
+
+    def start(self, path: str) -> str:
+        """Starts listening on a unix socket at the given path, and returns its base URL"""
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(asyncio.start_unix_server(self._handle, path), self._loop).result()
+        return f"unix://{path}"
+
+    def stop(self):
+        async def cancel_all():
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+
+        asyncio.run_coroutine_threadsafe(cancel_all(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        os.unlink(self.path)
+
+    def update(self, attrs: dict, action: str):
+        """Replaces a container's inspect record, and reports the change on the events streams"""
+        self.inspected[attrs["Id"]] = attrs
+        event = {
+            "Type": "container",
+            "Action": action,
+            "Actor": {"ID": attrs["Id"], "Attributes": {"image": attrs["Config"]["Image"], "name": attrs["Name"].lstrip("/")}},
+            "time": int(time.time()),
+        }
+        for subscriber in self._subscribers:
+            self._loop.call_soon_threadsafe(subscriber.put_nowait, event)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                request = await reader.readuntil(b"\r\n\r\n")
+                self.requests += 1
+                target = urlsplit(request.split(b" ")[1].decode())
+                path = self.VERSION_PREFIX.sub("", target.path)
+                query = parse_qs(target.query)
+                await asyncio.sleep(self.round_trip)
+                if path == "/events":
+                    await self._events(writer)
+                    return
+                status, body = self._respond(path, query)
+                data = json.dumps(body).encode()
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, path: str, query: dict):
+        if path == "/version":
+            return 200, {"ApiVersion": "1.44", "MinAPIVersion": "1.24", "Version": "fake"}
+        if path == "/containers/json":
+            running_only = query.get("all", ["0"])[0] in ("0", "false")
+            return 200, [summary(x) for x in self.inspected.values() if not running_only or x["State"]["Running"]]
+        match = re.fullmatch(r"/containers/([^/]+)/json", path)
+        if match:
+            name = unquote(match.group(1))
+            for attrs in self.inspected.values():
+                if name in (attrs["Id"], attrs["Name"].lstrip("/")):
+                    return 200, attrs
+            return 404, {"message": f"No such container: {name}"}
+        return 404, {"message": "page not found"}
+
+    async def _events(self, writer: asyncio.StreamWriter):
+        subscriber: asyncio.Queue = asyncio.Queue()
+        self._subscribers.append(subscriber)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n")
+            while True:
+                data = json.dumps(await subscriber.get()).encode() + b"\n"
+                writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                await writer.drain()
+        finally:
+            self._subscribers.remove(subscriber)
+
+
+def summary(attrs: dict) -> dict:
+    """The list API's view of a container"""
+    return {
+        "Id": attrs["Id"],
+        "Names": [attrs["Name"]],
+        "Image": attrs["Config"]["Image"],
+        "ImageID": attrs["Image"],
+        "Command": " ".join(attrs["Config"]["Cmd"] or []),
+        "Created": 0,
+        "Labels": attrs["Config"]["Labels"],
+        "State": attrs["State"]["Status"],
+        "Status": "Up",
+        "Ports": [],
+        "NetworkSettings": {"Networks": attrs["NetworkSettings"]["Networks"]},
+        "Mounts": attrs["Mounts"],
+    }
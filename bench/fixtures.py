@@ -0,0 +1,34 @@
+"""
+Description: Synthetic Docker container records for the benchmarks, derived from the recorded attrs in test.py
+"""
+
+import ast
+import copy
+import os
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.py")
+
+
+def _recorded_attrs() -> dict:
+    with open(TEST_FILE) as f:
+        module = ast.parse(f.read())
+    for node in module.body:
+        if isinstance(node, ast.Assign) and any(isinstance(x, ast.Name) and x.id == "attrs" for x in node.targets):
+            return ast.literal_eval(node.value)
+    raise LookupError(f"No attrs fixture in {TEST_FILE}")
+
+
+RECORDED_ATTRS = _recorded_attrs()
+
+
+def container_attrs(i: int, port: int, image: str = "itzg/minecraft-server:java21", running: bool = True) -> dict:
+    """Builds the inspect record of the i-th synthetic server container, publishing the game port on a given host port"""
+    attrs = copy.deepcopy(RECORDED_ATTRS)
+    attrs["Id"] = f"{i:064x}"
+    attrs["Name"] = f"/server-{i}"
+    attrs["Config"]["Image"] = image
+    attrs["Config"]["Labels"] = dict(attrs["Config"]["Labels"] or {})
+    attrs["State"]["Status"] = "running" if running else "exited"
+    attrs["State"]["Running"] = running
+    attrs["NetworkSettings"]["Ports"] = {"25565/tcp": [{"HostIp": "0.0.0.0", "HostPort": str(port)}]}
+    return attrs
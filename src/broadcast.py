@@ -0,0 +1,56 @@
+"""
+Description: Fan-out of server status events to any number of subscribers
+"""
+
+import asyncio
+from os import getenv
+from typing import Set, Union
+
+STREAM_QUEUE_SIZE = int(getenv("STREAM_QUEUE_SIZE", "256"))
+
+
+class Subscription:
+    def __init__(self, maxsize: int):
+        self.queue: "asyncio.Queue[Union[dict, None]]" = asyncio.Queue(maxsize)
+        self.dropped = False
+
+    async def get(self) -> Union[dict, None]:
+        """Waits for the next event, or None once this subscriber was dropped for falling behind"""
+        return await self.queue.get()
+
+
+class Broadcaster:
+    """Delivers every published event to all subscribers, each through their own bounded queue
+
+    A subscriber whose queue fills up is a slow consumer: rather than letting it hold back the others
+    (or grow without bound), its pending events are discarded and it is dropped.
+    """
+
+    def __init__(self, queue_size: int = STREAM_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: Set[Subscription] = set()
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+
+    def publish(self, event: dict):
+        for subscription in list(self._subscribers):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._drop(subscription)
+
+    def _drop(self, subscription: Subscription):
+        self.unsubscribe(subscription)
+        subscription.dropped = True
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
@@ -3,30 +3,162 @@ Author: Jose Stovall
 Description: Common utilities used to fetch current server statuses
 """
 
-from typing import List
+import asyncio
+from os import getenv
+from typing import Awaitable, Callable, List, Union
 
 from docker import DockerClient
+from docker.errors import NotFound
 from docker.models.containers import Container
 
+from engine import EngineClient
+from metrics import DOCKER_SECONDS
 from server import Server
 
+PING_CONCURRENCY = int(getenv("PING_CONCURRENCY", "32"))
 
-def list_servers(client: DockerClient, all: bool = False) -> List[dict]:
+
+def is_server_container(container: Container) -> bool:
+    """
+    Checks whether a container is a Minecraft server which should be listed
+    Arguments:
+        container (Container): the (fully inspected) container to check
+    Returns:
+        (bool) True if the container runs an itzg/minecraft-server image and isn't hidden
+    """
+
+    return "itzg/minecraft-server" in container.attrs["Config"]["Image"] and "net.forgeserv.hidden" not in container.labels
+
+
+def may_be_server_container(summary: dict) -> bool:
+    """
+    Checks whether a container from a sparse listing could be a Minecraft server which should be listed
+    Arguments:
+        summary (dict): the attrs of a sparse container, as returned by the list API
+    Returns:
+        (bool) False if the container certainly isn't a (visible) server, True if it needs a closer look
+    """
+
+    if "net.forgeserv.hidden" in (summary.get("Labels") or {}):
+        return False
+    # The list API reports the image ID instead of its name once that name points to a newer image,
+    #  i.e. after pulling an update, so only the full inspect can tell us about those
+    image = summary.get("Image", "")
+    return "itzg/minecraft-server" in image or image.startswith("sha256:")
+
+
+def list_containers(client: DockerClient, all: bool = False) -> List[Container]:
+    """
+    Lists all non-hidden Minecraft server containers on the current host
+    The host's containers are listed sparsely (without inspecting each of them), and only the ones
+    which may be servers are then inspected
+    Arguments:
+        all (bool): whether to return *all* containers, or just the running ones
+    Returns:
+        (List[Container]) The containers running an itzg/minecraft-server image
+    """
+
+    with DOCKER_SECONDS.time("list"):
+        listed = client.containers.list(all=all, sparse=True)
+    candidates = list(filter(lambda x: may_be_server_container(x.attrs), listed))
+    containers = []
+    for container in candidates:
+        try:
+            with DOCKER_SECONDS.time("inspect"):
+                container.reload()
+        except NotFound:
+            continue  # Removed since it was listed
+        if is_server_container(container):
+            containers.append(container)
+    return containers
+
+
+def get_container(client: DockerClient, name: str) -> Union[Container, None]:
+    """
+    Fetches a single Minecraft server container, without listing the host's containers
+    Arguments:
+        name (str): the name or ID of the container
+    Returns:
+        (Union[Container, None]) The container, or None if it doesn't exist, isn't a server or is hidden
+    """
+
+    try:
+        with DOCKER_SECONDS.time("inspect"):
+            container = client.containers.get(name)
+    except NotFound:
+        return None
+    return container if is_server_container(container) else None
+
+
+async def list_containers_async(engine: EngineClient, all: bool = False) -> List[Container]:
+    """
+    Lists all non-hidden Minecraft server containers on the current host, like list_containers, but on the
+    event loop: the candidates are then inspected concurrently, over the client's connection pool
+    Arguments:
+        all (bool): whether to return *all* containers, or just the running ones
+    Returns:
+        (List[Container]) The containers running an itzg/minecraft-server image
+    """
+
+    with DOCKER_SECONDS.time("list"):
+        listed = await engine.containers(all=all)
+    candidates = [x["Id"] for x in listed if may_be_server_container(x)]
+    inspected = await asyncio.gather(*(get_container_async(engine, x) for x in candidates))
+    return [x for x in inspected if x is not None]
+
+
+async def get_container_async(engine: EngineClient, name: str) -> Union[Container, None]:
+    """
+    Fetches a single Minecraft server container, like get_container, but on the event loop
+    Arguments:
+        name (str): the name or ID of the container
+    Returns:
+        (Union[Container, None]) The container, or None if it doesn't exist, isn't a server or is hidden
+    """
+
+    try:
+        with DOCKER_SECONDS.time("inspect"):
+            container = Container(attrs=await engine.inspect_container(name))
+    except NotFound:
+        return None
+    return container if is_server_container(container) else None
+
+
+async def list_servers(client: Union[DockerClient, EngineClient], all: bool = False) -> List[dict]:
     """
     Distills the container data for all servers on the current host into a usable format
+    Every server is pinged concurrently, at most PING_CONCURRENCY at a time
     Arguments:
         all (bool): whether to return *all* servers, or just the running one
     Returns:
-        (List[Dict[str, any]]) A list of results from __extract_info
+        (List[Dict[str, any]]) A list of results from Server.asdict
+    """
+
+    if isinstance(client, EngineClient):
+        containers = await list_containers_async(client, all)
+    else:
+        containers = await asyncio.to_thread(list_containers, client, all)
+    return [x.asdict() for x in await probe_servers(containers)]
+
+
+async def probe_servers(
+    containers: List[Container],
+    probe: Callable[[Container], Awaitable[Union[Server, None]]] = Server.from_container_async,
+) -> List[Server]:
+    """
+    Pings the given server containers concurrently, at most PING_CONCURRENCY at a time
+    Arguments:
+        containers (List[Container]): the server containers to ping
+        probe (Callable): builds the server of a container, or returns None if it should be left out
+    Returns:
+        (List[Server]) The servers which responded
     """
 
-    containers: List[Container] = list(
-        filter(
-            lambda x: "itzg/minecraft-server" in x.attrs["Config"]["Image"] and "net.forgeserv.hidden" not in x.labels,
-            client.containers.list(all=all),
-        )
-    )
+    semaphore = asyncio.Semaphore(PING_CONCURRENCY)
+
+    async def limited(container: Container):
+        async with semaphore:
+            return await probe(container)
 
-    ret = [Server.from_container(c) for c in containers]
-    ret = list(filter(lambda x: x is not None, ret))
-    return [x.asdict() for x in ret]  # type: ignore
+    ret = await asyncio.gather(*(limited(c) for c in containers))
+    return list(filter(lambda x: x is not None, ret))  # type: ignore
@@ -0,0 +1,97 @@
+"""
+Description: Content-Encoding negotiation and compression of responses
+
+Brotli is used when the brotli package is installed, gzip otherwise.
+"""
+
+import asyncio
+import gzip
+import threading
+from collections import OrderedDict
+from os import getenv
+from typing import Union
+
+from metrics import CACHE_REQUESTS
+from singleflight import SingleFlight
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+# Smaller bodies aren't worth the CPU, nor the compression's overhead
+COMPRESS_MIN_SIZE = int(getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_CACHE_SIZE = int(getenv("COMPRESS_CACHE_SIZE", "32"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# In order of preference
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(accept_encoding: str) -> Union[str, None]:
+    """
+    Picks the encoding to respond with
+    Arguments:
+        accept_encoding (str): the request's Accept-Encoding header
+    Returns:
+        (Union[str, None]) The preferred encoding the client accepts, None for the identity
+    """
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)  # type: ignore
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class CompressionCache:
+    """LRU cache of compressed bodies, keyed by their ETag (which identifies the encoding too), so each
+    snapshot's responses are only compressed once however many clients ask for them
+
+    Misses are compressed in a worker thread, so the event loop keeps serving the other requests meanwhile,
+    and concurrent misses for the same ETag share that one compression.
+    """
+
+    def __init__(self, max_entries: int = COMPRESS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._bodies: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._compressions = SingleFlight("compression")
+
+    async def get(self, etag: str, body: bytes, encoding: str) -> bytes:
+        with self._lock:
+            compressed = self._bodies.get(etag)
+            if compressed is not None:
+                self._bodies.move_to_end(etag)
+                CACHE_REQUESTS.inc("compression", "hit")
+                return compressed
+
+        CACHE_REQUESTS.inc("compression", "miss")
+        return await self._compressions.do(etag, lambda: self._compress(etag, body, encoding))
+
+    async def _compress(self, etag: str, body: bytes, encoding: str) -> bytes:
+        compressed = await asyncio.to_thread(compress, body, encoding)
+        with self._lock:
+            self._bodies[etag] = compressed
+            while len(self._bodies) > self.max_entries:
+                self._bodies.popitem(last=False)
+        return compressed
+
+
+compression_cache = CompressionCache()
@@ -0,0 +1,208 @@
+"""
+Description: Minimal asyncio client of the Docker Engine API, over the daemon's unix socket
+
+Covers only the calls the service makes (listing and inspecting containers, following their events), so
+that those run on the event loop instead of each tying up a thread as docker-py's blocking calls do.
+Connections are kept alive and pooled, and failures are reported with docker-py's own exceptions.
+"""
+
+import asyncio
+import json
+from os import getenv
+from typing import AsyncIterator, Dict, List, Tuple, Union
+from urllib.parse import quote, urlencode
+
+from docker.errors import APIError, NotFound
+
+# Unversioned paths are served with the daemon's own API version
+API_VERSION = getenv("DOCKER_API_VERSION", "")
+DEFAULT_SOCKET = "/var/run/docker.sock"
+EVENTS_READ_SIZE = 64 * 1024
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+def convert_filters(filters: dict) -> str:
+    """Encodes filters the way the Engine API expects them, i.e. {"label": ["a", "b"], "status": ["running"]}"""
+    converted = {}
+    for key, value in filters.items():
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        converted[key] = value if isinstance(value, list) else [value]
+    return json.dumps(converted)
+
+
+class EngineClient:
+    """Asynchronous Docker Engine API client, mirroring the docker.APIClient methods the service uses
+
+    Requests share at most pool_size keep-alive connections to the socket; a pooled connection which the
+    daemon closed while idle is replaced transparently. The events stream holds its own connection.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, timeout: float = 10, pool_size: int = 10):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._idle: List[Connection] = []
+        self._slots = asyncio.Semaphore(pool_size)
+
+    async def containers(self, all: bool = False, filters: Union[dict, None] = None) -> List[dict]:
+        """
+        Lists the host's containers, sparsely (as the list API reports them)
+        Arguments:
+            all (bool): whether to list *all* containers, or just the running ones
+            filters (Union[dict, None]): the filters to apply, i.e. {"label": "net.forgeserv.hidden"}
+        Returns:
+            (List[dict]) The containers' summaries
+        """
+
+        params = {"all": "1"} if all else {}
+        if filters:
+            params["filters"] = convert_filters(filters)
+        return await self._get("/containers/json", params)
+
+    async def inspect_container(self, container: str) -> dict:
+        """
+        Inspects a single container
+        Arguments:
+            container (str): the name or ID of the container
+        Returns:
+            (dict) The container's attrs, raising docker.errors.NotFound if it doesn't exist
+        """
+
+        return await self._get(f"/containers/{quote(container, safe='')}/json")
+
+    async def events(self, since: Union[int, None] = None, filters: Union[dict, None] = None) -> AsyncIterator[dict]:
+        """
+        Follows the daemon's events stream, until the daemon ends it or the iteration is stopped
+        Arguments:
+            since (Union[int, None]): the time to replay the events from
+            filters (Union[dict, None]): the filters to apply, i.e. {"type": "container"}
+        Returns:
+            (AsyncIterator[dict]) The decoded events
+        """
+
+        params: Dict[str, str] = {}
+        if since is not None:
+            params["since"] = str(since)
+        if filters:
+            params["filters"] = convert_filters(filters)
+
+        reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.socket_path), self.timeout)
+        try:
+            writer.write(self._request_head(self._target("/events", params)))
+            await writer.drain()
+            status, headers = await asyncio.wait_for(self._read_head(reader), self.timeout)
+            if status >= 400:
+                self._raise_for_status(status, await self._read_body(reader, headers))
+
+            buffer = b""
+            async for chunk in self._stream(reader, headers):
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+        finally:
+            writer.close()
+
+    def close(self):
+        """Closes the pooled connections"""
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+    async def _get(self, path: str, params: Union[Dict[str, str], None] = None):
+        status, body = await asyncio.wait_for(self._request(self._target(path, params)), self.timeout)
+        self._raise_for_status(status, body)
+        return json.loads(body)
+
+    async def _request(self, target: str) -> Tuple[int, bytes]:
+        async with self._slots:
+            while True:
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await asyncio.open_unix_connection(self.socket_path)
+                try:
+                    writer.write(self._request_head(target))
+                    await writer.drain()
+                    status, headers = await self._read_head(reader)
+                    body = await self._read_body(reader, headers)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        continue  # The daemon closed it while it was idle, try the next one
+                    raise
+                except BaseException:
+                    writer.close()  # Timed out or cancelled mid-response, so it can't be reused
+                    raise
+
+                if self._keep_alive(headers):
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, body
+
+    @staticmethod
+    def _target(path: str, params: Union[Dict[str, str], None] = None) -> str:
+        prefix = f"/v{API_VERSION.lstrip('v')}" if API_VERSION else ""
+        return prefix + path + (f"?{urlencode(params)}" if params else "")
+
+    @staticmethod
+    def _request_head(target: str) -> bytes:
+        return f"GET {target} HTTP/1.1\r\nHost: docker\r\nUser-Agent: ForgeServ-API\r\nAccept: application/json\r\n\r\n".encode()
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader) -> Tuple[int, Dict[str, str]]:
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(b"", None)
+        status = int(line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return status, headers
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+    @staticmethod
+    async def _read_body(reader: asyncio.StreamReader, headers: Dict[str, str]) -> bytes:
+        if "content-length" in headers:
+            return await reader.readexactly(int(headers["content-length"]))
+        return b"".join([x async for x in EngineClient._stream(reader, headers)])
+
+    @staticmethod
+    async def _stream(reader: asyncio.StreamReader, headers: Dict[str, str]) -> AsyncIterator[bytes]:
+        """Yields the body of a response as it comes, de-chunked"""
+
+        if headers.get("transfer-encoding", "").lower() != "chunked":
+            while chunk := await reader.read(EVENTS_READ_SIZE):  # Delimited by the end of the connection
+                yield chunk
+            return
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+            size = int(line.split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()  # The Engine API sends no trailers
+                return
+            yield await reader.readexactly(size)
+            await reader.readexactly(2)
+
+    @staticmethod
+    def _keep_alive(headers: Dict[str, str]) -> bool:
+        framed = "content-length" in headers or headers.get("transfer-encoding", "").lower() == "chunked"
+        return framed and headers.get("connection", "").lower() != "close"
+
+    @staticmethod
+    def _raise_for_status(status: int, body: bytes):
+        if status < 400:
+            return
+        try:
+            explanation = json.loads(body).get("message", "")
+        except ValueError:
+            explanation = body.decode(errors="replace")
+        if status == 404:
+            raise NotFound(f"{status} Client Error: Not Found", explanation=explanation)
+        raise APIError(f"{status} Error from the Docker daemon", explanation=explanation)
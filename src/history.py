@@ -0,0 +1,241 @@
+"""
+Description: Per-server player count and ping latency history, kept in fixed-size ring buffers
+
+Every refresh appends one sample per server to the raw tier, and folds it into the downsampled tiers
+(1 minute and 1 hour averages). Each tier holds at most HISTORY_SIZE samples, stored as flat arrays of
+unsigned ints rather than Python objects, so a server's whole history only takes a few tens of KiB.
+The buffers are periodically snapshotted to HISTORY_FILE (if set) so they survive a restart.
+"""
+
+import logging
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from os import getenv
+from typing import Dict, Iterable, List, Tuple, Union
+
+from server import Server
+
+HISTORY_SIZE = int(getenv("HISTORY_SIZE", "1440"))
+HISTORY_FILE = getenv("HISTORY_FILE", "")
+HISTORY_SAVE_INTERVAL = float(getenv("HISTORY_SAVE_INTERVAL", "60"))
+# Name and resolution (in seconds, 0 meaning every sample) of each tier
+TIERS: Tuple[Tuple[str, int], ...] = (("raw", 0), ("1m", 60), ("1h", 3600))
+# How long the history of a server which is no longer seen is kept, by default as long as the widest tier spans
+HISTORY_RETENTION = float(getenv("HISTORY_RETENTION", str(max(x for _, x in TIERS) * HISTORY_SIZE)))
+
+MAGIC = b"FSHIST01"
+# magic, capacity of each tier, tier count, server count
+HEADER = struct.Struct("<8sIHI")
+TIER_HEADER = struct.Struct("<II")  # head, count
+KEY_LENGTH = struct.Struct("<H")
+U16_MAX = 0xFFFF
+
+logger = logging.getLogger(__name__)
+
+
+def _u16(value: float) -> int:
+    return min(max(int(round(value)), 0), U16_MAX)
+
+
+class Ring:
+    """Fixed-size ring of (time, online, max, latency) samples, one array per column
+
+    Times are unix timestamps in seconds, latencies are in milliseconds (0 when the server couldn't be pinged).
+    """
+
+    COLUMNS = ("times", "online", "max", "latency")
+
+    def __init__(self, capacity: int = HISTORY_SIZE):
+        self.capacity = capacity
+        self.times = array("I", bytes(4 * capacity))
+        self.online = array("H", bytes(2 * capacity))
+        self.max = array("H", bytes(2 * capacity))
+        self.latency = array("H", bytes(2 * capacity))
+        self.head = 0  # Where the next sample goes
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def latest(self) -> int:
+        """Gets the time of the newest sample, 0 if there is none"""
+        return self.times[self.head - 1] if self.count else 0
+
+    def append(self, time: int, online: int, max: int, latency: int):
+        i = self.head
+        self.times[i] = time
+        self.online[i] = online
+        self.max[i] = max
+        self.latency[i] = latency
+        self.head = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def ordered(self, column: str) -> array:
+        """Gets a column's samples from the oldest to the newest"""
+        values = getattr(self, column)
+        if self.count < self.capacity:
+            return values[: self.count]
+        return values[self.head :] + values[: self.head]
+
+    def range(self, start: float, end: float) -> Dict[str, List[int]]:
+        """Gets the samples taken between two timestamps (both included), column by column"""
+        times = self.ordered("times")
+        lo, hi = bisect_left(times, start), bisect_right(times, end)
+        return {column: self.ordered(column)[lo:hi].tolist() for column in Ring.COLUMNS}
+
+
+class Tier:
+    """A ring of samples averaged over buckets of a fixed resolution"""
+
+    def __init__(self, resolution: int, capacity: int = HISTORY_SIZE):
+        self.resolution = resolution
+        self.ring = Ring(capacity)
+        # The bucket being filled: its start, sample count, and the sums (or peak, for max) of its samples
+        self._bucket = 0
+        self._samples = 0
+        self._online = 0
+        self._max = 0
+        self._latency = 0
+
+    def add(self, time: int, online: int, max: int, latency: int):
+        if not self.resolution:
+            self.ring.append(time, online, max, latency)
+            return
+
+        bucket = time - time % self.resolution
+        if bucket != self._bucket and self._samples:
+            self.flush()
+        self._bucket = bucket
+        self._samples += 1
+        self._online += online
+        self._max = max if max > self._max else self._max
+        self._latency += latency
+
+    def flush(self):
+        n = self._samples
+        self.ring.append(self._bucket, _u16(self._online / n), self._max, _u16(self._latency / n))
+        self._samples = self._online = self._max = self._latency = 0
+
+
+class ServerHistory:
+    def __init__(self, capacity: int = HISTORY_SIZE):
+        self.tiers = {name: Tier(resolution, capacity) for name, resolution in TIERS}
+
+    @property
+    def last_seen(self) -> int:
+        return self.tiers[TIERS[0][0]].ring.latest()
+
+    def add(self, time: int, online: int, max: int, latency: int):
+        for tier in self.tiers.values():
+            tier.add(time, online, max, latency)
+
+
+class PlayerHistory:
+    """The history of every server seen within the retention period, by server key (host/name)
+
+    Servers which weren't seen for longer than that, i.e. removed or renamed containers, are dropped.
+    """
+
+    def __init__(self, capacity: int = HISTORY_SIZE, retention: float = HISTORY_RETENTION):
+        self.capacity = capacity
+        self.retention = retention
+        self._servers: Dict[str, ServerHistory] = {}
+
+    def record(self, servers: Iterable[Server], latencies: Dict[str, float], now: float):
+        """Appends a sample for each server
+
+        Args:
+            servers (Iterable[Server]): The servers, as of the latest refresh
+            latencies (Dict[str, float]): The round trip time of each server's latest successful ping, in seconds
+            now (float): The time of the refresh, as a unix timestamp
+        """
+
+        for server in servers:
+            history = self._servers.get(server.key)
+            if history is None:
+                history = self._servers[server.key] = ServerHistory(self.capacity)
+            latency = _u16(latencies[server.key] * 1000) if server.error is None and server.key in latencies else 0
+            history.add(int(now), _u16(server.online), _u16(server.max), latency)
+
+        stale = [key for key, history in self._servers.items() if now - history.last_seen > self.retention]
+        for key in stale:
+            del self._servers[key]
+
+    def find(self, name: str, host: str = "") -> Union[Tuple[str, ServerHistory], None]:
+        """Looks up a server's history by name, on any host unless one is given
+
+        Returns:
+            Union[Tuple[str, ServerHistory], None]: The server's key and history, or None if it was never seen
+        """
+
+        if host:
+            key = f"{host}/{name}"
+            history = self._servers.get(key)
+            return (key, history) if history is not None else None
+        for key, history in self._servers.items():
+            if key.rpartition("/")[2] == name:
+                return key, history
+        return None
+
+    def dump(self) -> bytes:
+        """Serializes every buffer, in the format read by load()"""
+        parts = [HEADER.pack(MAGIC, self.capacity, len(TIERS), len(self._servers))]
+        for key, history in self._servers.items():
+            encoded = key.encode()
+            parts += [KEY_LENGTH.pack(len(encoded)), encoded]
+            for tier in history.tiers.values():
+                ring = tier.ring
+                parts.append(TIER_HEADER.pack(ring.head, ring.count))
+                parts += [getattr(ring, column).tobytes() for column in Ring.COLUMNS]
+        return b"".join(parts)
+
+    def save(self, path: str, data: bytes):
+        """Writes a dump() to a memory-mapped file, replacing the previous one atomically"""
+        temporary = path + ".tmp"
+        with open(temporary, "w+b") as f:
+            f.truncate(len(data))
+            with mmap.mmap(f.fileno(), len(data)) as mapped:
+                mapped[:] = data
+                mapped.flush()
+        os.replace(temporary, path)
+
+    def load(self, path: str):
+        """Restores the buffers saved in a file, if it exists and was written with the same HISTORY_SIZE
+        Samples accumulated in a downsampled tier's current bucket aren't saved, and are lost on restart"""
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                self._servers = self._parse(mapped)
+        except FileNotFoundError:
+            pass
+        except (ValueError, struct.error) as e:
+            logger.warning("Ignoring the player history in %s: %s", path, e)
+
+    def _parse(self, data: mmap.mmap) -> Dict[str, ServerHistory]:
+        magic, capacity, tiers, count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or capacity != self.capacity or tiers != len(TIERS):
+            raise ValueError("written by another version, or with another HISTORY_SIZE")
+
+        servers = {}
+        offset = HEADER.size
+        for _ in range(count):
+            (length,) = KEY_LENGTH.unpack_from(data, offset)
+            offset += KEY_LENGTH.size
+            key = data[offset : offset + length].decode()
+            offset += length
+            history = servers[key] = ServerHistory(capacity)
+            for tier in history.tiers.values():
+                ring = tier.ring
+                ring.head, ring.count = TIER_HEADER.unpack_from(data, offset)
+                offset += TIER_HEADER.size
+                for column in Ring.COLUMNS:
+                    values = array(getattr(ring, column).typecode)
+                    size = values.itemsize * capacity
+                    if offset + size > len(data):
+                        raise ValueError("truncated file")
+                    values.frombytes(data[offset : offset + size])
+                    setattr(ring, column, values)
+                    offset += size
+        return servers
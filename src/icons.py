@@ -0,0 +1,87 @@
+"""
+Description: Content-addressed, bounded cache of server favicons
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from os import getenv
+from typing import Iterable, Union
+
+from metrics import CACHE_REQUESTS
+
+ICON_CACHE_SIZE = int(getenv("ICON_CACHE_SIZE", "256"))
+
+
+class IconCache:
+    """LRU cache of PNG favicons keyed by the hash of their content, so identical icons are stored once
+
+    The icons the current snapshot links to are pinned, and never evicted: servers only put their icon when
+    pinged, so the icons of servers reported from their last status or health check would otherwise age out
+    while still linked. The cache may thus hold more than max_entries icons, when more servers are live.
+    """
+
+    def __init__(self, max_entries: int = ICON_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._icons: "OrderedDict[str, bytes]" = OrderedDict()
+        self._pinned: "frozenset[str]" = frozenset()
+        self._lock = threading.Lock()
+
+    def put(self, icon: bytes) -> str:
+        """Stores an icon, evicting the least recently used one if the cache is full
+
+        Args:
+            icon (bytes): The raw PNG data
+
+        Returns:
+            str: The hash the icon is stored (and served) under
+        """
+
+        digest = hashlib.sha256(icon).hexdigest()
+        with self._lock:
+            if digest in self._icons:
+                self._icons.move_to_end(digest)
+                CACHE_REQUESTS.inc("icons", "hit")
+            else:
+                CACHE_REQUESTS.inc("icons", "miss")
+                self._icons[digest] = icon
+                self._evict(keep=digest)
+        return digest
+
+    def pin(self, digests: Iterable[str]):
+        """Keeps the given icons from being evicted, unpinning all others
+
+        Args:
+            digests (Iterable[str]): The hashes of the icons the current snapshot links to
+        """
+
+        with self._lock:
+            self._pinned = frozenset(digests)
+            self._evict()
+
+    def _evict(self, keep: str = ""):
+        """Evicts the least recently used unpinned icons (but keep) until the cache is back to max_entries"""
+        for digest in list(self._icons):
+            if len(self._icons) <= self.max_entries:
+                return
+            if digest != keep and digest not in self._pinned:
+                del self._icons[digest]
+
+    def get(self, digest: str) -> Union[bytes, None]:
+        with self._lock:
+            icon = self._icons.get(digest)
+            if icon is not None:
+                self._icons.move_to_end(digest)
+            return icon
+
+
+def icon_url(digest: str) -> str:
+    return f"/icons/{digest}.png"
+
+
+def icon_digest(url: str) -> str:
+    """The inverse of icon_url"""
+    return url.removeprefix("/icons/").removesuffix(".png")
+
+
+icon_cache = IconCache()
@@ -0,0 +1,176 @@
+"""
+Description: Event-driven inventory of the Minecraft server containers on the current host
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, List, Union
+
+from docker import DockerClient
+from docker.errors import NotFound
+from docker.models.containers import Container
+
+from common import get_container_async, is_server_container, list_containers, list_containers_async
+from engine import EngineClient
+from metrics import DOCKER_SECONDS
+from server import HEALTH_MAX_AGE
+
+RESYNC_DELAY = 5
+
+# Actions (as reported by the Docker events stream) after which a container's attrs must be re-read.
+#  exec_die ends every health check run, which only matters when its output stands in for pings
+REFRESH_ACTIONS = {"create", "start", "restart", "stop", "die", "kill", "pause", "unpause", "update", "rename", "health_status"}
+if HEALTH_MAX_AGE:
+    REFRESH_ACTIONS.add("exec_die")
+
+logger = logging.getLogger(__name__)
+
+
+class ContainerInventory:
+    """Keeps track of all Minecraft server containers on the host
+
+    A single full listing seeds the inventory, after which the Docker events stream is followed in a
+    background thread to add, refresh and drop containers as they change. The tracked containers are kept
+    in a dict which is replaced (never mutated) on every change, so readers never need a lock.
+    Given an EngineClient, the listing and the events stream go through it instead, in an asyncio task.
+    """
+
+    def __init__(self, client: DockerClient, engine: Union[EngineClient, None] = None):
+        self.client = client
+        self.engine = engine
+        self._containers: Dict[str, Container] = {}
+        self._since = 0
+        self._stream = None
+        self._stopped = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+        self._task: "Union[asyncio.Task[None], None]" = None
+
+    def containers(self, all: bool = False) -> List[Container]:
+        """
+        Gets the tracked containers
+        Arguments:
+            all (bool): whether to return *all* containers, or just the running ones
+        Returns:
+            (List[Container]) The tracked containers
+        """
+
+        containers = list(self._containers.values())
+        if all:
+            return containers
+        return [x for x in containers if x.status == "running"]
+
+    def sync(self):
+        """Replaces the inventory with a full listing of the host's containers"""
+
+        since = int(time.time())
+        self._containers = {x.id: x for x in list_containers(self.client, all=True)}  # type: ignore
+        self._since = since
+
+    async def sync_async(self):
+        """Replaces the inventory with a full listing of the host's containers, without blocking the event loop"""
+
+        if self.engine is None:
+            await asyncio.to_thread(self.sync)
+            return
+        since = int(time.time())
+        self._containers = {x.id: x for x in await list_containers_async(self.engine, all=True)}  # type: ignore
+        self._since = since
+
+    def start(self):
+        if self.engine is not None:
+            if self._task is None:
+                self._task = asyncio.create_task(self._follow_async())
+        elif self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._follow, name="container-inventory", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._stream is not None:
+            self._stream.close()
+        self._thread = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _follow(self):
+        while not self._stopped.is_set():
+            try:
+                self._stream = self.client.api.events(since=self._since, decode=True, filters={"type": "container"})
+                for event in self._stream:
+                    self._since = event.get("time", self._since)
+                    self._handle(event)
+            except Exception:
+                if self._stopped.is_set():
+                    return
+                logger.exception("Lost the Docker events stream, resyncing")
+
+            # The stream ended or broke, so we may have missed events: start over from a full listing
+            self._stopped.wait(RESYNC_DELAY)
+            if not self._stopped.is_set():
+                try:
+                    self.sync()
+                except Exception:
+                    logger.exception("Failed to resync the container inventory")
+
+    async def _follow_async(self):
+        while True:
+            try:
+                async for event in self.engine.events(since=self._since, filters={"type": "container"}):  # type: ignore
+                    self._since = event.get("time", self._since)
+                    container_id = self._to_inspect(event)
+                    if container_id is not None:
+                        self._apply(container_id, await get_container_async(self.engine, container_id))  # type: ignore
+            except Exception:
+                logger.exception("Lost the Docker events stream, resyncing")
+
+            await asyncio.sleep(RESYNC_DELAY)
+            try:
+                await self.sync_async()
+            except Exception:
+                logger.exception("Failed to resync the container inventory")
+
+    def _handle(self, event: dict):
+        container_id = self._to_inspect(event)
+        if container_id is None:
+            return
+        try:
+            with DOCKER_SECONDS.time("inspect"):
+                container = self.client.containers.get(container_id)
+        except NotFound:
+            container = None
+        self._apply(container_id, container if container is not None and is_server_container(container) else None)
+
+    def _to_inspect(self, event: dict) -> Union[str, None]:
+        """Applies an event which needs no inspect, returning the ID of the container to re-read otherwise"""
+
+        container_id = event.get("id") or event.get("Actor", {}).get("ID")
+        # health_status actions carry the status as a suffix, i.e. "health_status: healthy"
+        action = event.get("Action", event.get("status", "")).split(":")[0]
+        if not container_id:
+            return None
+
+        if action == "destroy":
+            self._drop(container_id)
+            return None
+        if action not in REFRESH_ACTIONS:
+            return None
+
+        image = event.get("Actor", {}).get("Attributes", {}).get("image", "")
+        if container_id not in self._containers and "itzg/minecraft-server" not in image:
+            return None  # Not one of ours, don't bother inspecting it
+        return container_id
+
+    def _apply(self, container_id: str, container: Union[Container, None]):
+        """Tracks the re-read container, or drops it if it's gone or no longer a (visible) server"""
+        if container is not None:
+            self._containers = {**self._containers, container_id: container}
+        else:
+            self._drop(container_id)
+
+    def _drop(self, container_id: str):
+        if container_id in self._containers:
+            self._containers = {k: v for k, v in self._containers.items() if k != container_id}
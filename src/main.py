@@ -5,32 +5,325 @@ Description: A Flask API service for the running Minecraft server statuses
 Run via Docker with either network mode = HOST, **OR** set the environment variable HOST_IP to the IP of your server
 """
 
-import docker
-from fastapi import FastAPI, Response, status
+import asyncio
+import json
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Sequence, Tuple, Union
+
+from docker.models.containers import Container
+from fastapi import FastAPI, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+
+from compression import COMPRESS_MIN_SIZE, compression_cache, negotiate
+from history import TIERS, Ring
+from hosts import DockerHost, hosts_from_env
+from icons import icon_cache
+from metrics import HTTP_SECONDS, registry
+from poller import Changes, StatusPoller, digest
+from ping import PingError
+from server import Server, render_json, render_servers
+from shared import SHARED_SNAPSHOT, SharedSnapshot
+from singleflight import SingleFlight
+
+STREAM_KEEPALIVE = 15
+NDJSON = "application/x-ndjson"
+NDJSON_CHUNK_SIZE = 64 * 1024
+# Players have no meaningful order
+SORT_KEYS = tuple(x for x in Server.FIELDS if x != "players")
+
+hosts = hosts_from_env()
+poller = StatusPoller(hosts, shared=SharedSnapshot(SHARED_SNAPSHOT) if SHARED_SNAPSHOT else None)
+server_lookups = SingleFlight("server")
+logger = logging.getLogger(__name__)
 
-from common import list_servers
 
-app: FastAPI = FastAPI()
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await poller.start()
+    yield
+    await poller.stop()
+
+
+app: FastAPI = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins="*",
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Age", "ETag", "X-Generated-At", "X-Snapshot-Version", "X-Total-Count"],
 )
 
-client = docker.from_env()
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_SECONDS.observe(route.path if route else "unmatched", value=time.perf_counter() - start)
+    return response
 
 
 @app.get("/")
-def index(response: Response, all: bool = False, sort: str = ""):
+async def index(
+    request: Request,
+    response: Response,
+    all: bool = False,
+    sort: str = "",
+    since: Union[int, None] = None,
+    fields: str = "",
+    status_filter: str = Query("", alias="status"),
+    type_filter: str = Query("", alias="type"),
+    min_online: int = 0,
+    limit: Union[int, None] = Query(None, ge=0),
+    offset: int = Query(0, ge=0),
+):
+    """The servers, optionally projected to some fields (fields=name,online), filtered by status, type
+    (ignoring case) or player count, and paginated; X-Total-Count tells how many servers matched.
+    Streamed one server per line with Accept: application/x-ndjson, and compressed if accepted otherwise"""
+
+    snapshot = await poller.get()
+    ndjson = wants_ndjson(request)
+    encoding = negotiate(request.headers.get("accept-encoding", "")) if not ndjson else None
+    query = (all, sort, fields, status_filter, type_filter, min_online, limit, offset, ndjson, encoding)
+    headers = {
+        "Age": str(int(snapshot.age)),
+        "ETag": f'"{digest(f"{snapshot.etag}/{query}")}"',
+        "X-Generated-At": datetime.fromtimestamp(snapshot.generated_at, timezone.utc).isoformat(),
+        "X-Snapshot-Version": str(snapshot.version),
+        "Vary": "Accept, Accept-Encoding",
+    }
+
+    if since is not None:
+        del headers["ETag"]
+        changes = poller.changes(snapshot, since, all=all)
+        full = changes is None
+        if changes is None:  # Unknown version, the client has to start over from the full list
+            changes = Changes(changed=snapshot.visible(all), removed=[])
+        body = b'{"version":%d,"full":%s,"changed":%s,"removed":%s}' % (
+            snapshot.version,
+            b"true" if full else b"false",
+            render_servers(changes.changed),
+            render_json(changes.removed),
+        )
+        return Response(body, media_type="application/json", headers=headers)
+
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    requested = [x.strip() for x in fields.split(",") if x.strip()]
+    unknown = [x for x in requested if x not in Server.FIELDS] + ([sort] if sort and sort not in SORT_KEYS else [])
+    if unknown:
+        response.headers.update(headers)
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": f"Failed to find key {unknown[0]}"}
+
+    # Sort orders are computed once per snapshot, so a request only has to filter them
+    data = snapshot.sorted_by(sort) if sort else snapshot.servers
+    if not all and not status_filter:
+        data = [x for x in data if x.status == "running"]
+    if status_filter:
+        data = [x for x in data if x.status == status_filter]
+    if type_filter:
+        data = [x for x in data if x.type.lower() == type_filter.lower()]
+    if min_online:
+        data = [x for x in data if x.online >= min_online]
+    headers["X-Total-Count"] = str(len(data))
+    data = data[offset : offset + limit if limit is not None else None]
+    # Every server's JSON is rendered once per change, so a response only has to stitch them together
+    #  (or, for a projection, render just the requested fields)
+    projection = tuple(x for x in Server.FIELDS if x in requested) or None
+    if ndjson:
+        return StreamingResponse(ndjson_lines(data, projection), media_type=NDJSON, headers=headers)
+    body = render_servers(data, projection)
+    if encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+        # The ETag covers the encoding, so it identifies the compressed body too
+        body = await compression_cache.get(headers["ETag"], body, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.get("/servers/{name}")
+async def server(name: str, response: Response, host: str = ""):
+    """A single server, fetched and pinged on demand rather than read from the snapshot"""
+
+    found = await fetch_server(name, host)
+    if found is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"error": f"Failed to find server {name}"}
+    return Response(found.json_bytes, media_type="application/json")
+
+
+@app.get("/servers")
+async def servers(request: Request, response: Response, names: str, host: str = ""):
+    """Some servers, by comma separated names, fetched and pinged on demand rather than read from the snapshot
+    With Accept: application/x-ndjson, each server is streamed as soon as it answered (or turned out missing)"""
+
+    requested = list(dict.fromkeys(filter(None, (x.strip() for x in names.split(",")))))
+    if wants_ndjson(request):
+        return StreamingResponse(fetch_lines(requested, host), media_type=NDJSON)
+
+    found = await asyncio.gather(*(fetch_server(x, host) for x in requested))
+    missing = [name for name, x in zip(requested, found) if x is None]
+    if missing:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"error": f"Failed to find servers {', '.join(missing)}"}
+    return Response(render_servers(found), media_type="application/json")  # type: ignore
+
+
+async def fetch_lines(names: List[str], host: str = "") -> AsyncIterator[bytes]:
+    async def named(name: str):
+        return name, await fetch_server(name, host)
+
+    for done in asyncio.as_completed([named(x) for x in names]):
+        name, found = await done
+        yield (found.json_bytes if found is not None else render_json({"name": name, "error": "not_found"})) + b"\n"
+
+
+async def fetch_server(name: str, host: str = "") -> Union[Server, None]:
+    """Looks a server container up by name, on the given host or else on every host, and pings it
+    Concurrent requests for the same server share a single lookup and ping"""
+
+    return await server_lookups.do((host, name), lambda: lookup_server(name, host))
+
+
+async def lookup_server(name: str, host: str = "") -> Union[Server, None]:
+    candidates = [x for x in hosts if not host or x.name == host]
+    containers = await asyncio.gather(*(x.get_container(name) for x in candidates), return_exceptions=True)
+    for docker_host, container in zip(candidates, containers):
+        if isinstance(container, Exception):
+            logger.warning("Failed to look up container %s on host %s: %s", name, docker_host.name, container)
+        elif container is not None:
+            return await probe_container(docker_host, container)
+    return None
+
+
+async def probe_container(host: DockerHost, container: Container) -> Server:
+    if container.status != "running":
+        return Server.unreachable(container, "not_running", host=host.name)
     try:
-        data = list_servers(client, all=all)
-        if sort:
-            data = sorted(data, key=lambda x: x[sort])
-        response.status_code = status.HTTP_200_OK
-        return data
-    except KeyError:
+        return await Server.probe(container, ip=host.ping_ip, host=host.name)
+    except PingError as e:
+        return Server.unreachable(container, e.reason, host=host.name)
+
+
+@app.get("/players")
+async def players():
+    """Every online player, with the servers they're on, straight from the players index (no pings)"""
+    await poller.get()
+    return Response(poller.players.online_json(), media_type="application/json")
+
+
+@app.get("/players/{name}")
+async def player(name: str, response: Response):
+    """The online players whose name starts with a given prefix (ignoring case), or with a given UUID"""
+    await poller.get()
+    found = poller.players.search(name)
+    if not found:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"error": f"Failed to find player {name}"}
+    return Response(render_json(found), media_type="application/json")
+
+
+@app.get("/stream")
+async def stream():
+    """Server-Sent Events stream of server statuses: a "snapshot" event with every server,
+    followed by "changed" and "removed" events as the servers change, and "join" and "leave" events as players do"""
+
+    subscription = poller.broadcaster.subscribe()
+    snapshot = await poller.get()
+
+    async def events():
+        try:
+            yield sse("snapshot", {"version": snapshot.version, "servers": [x.asdict() for x in snapshot.servers]})
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:  # Dropped for falling behind, the client has to reconnect
+                    return
+                if event["version"] > snapshot.version:
+                    yield sse(event["event"], event["data"], event["version"])
+        finally:
+            poller.broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def sse(event: str, data: Union[dict, list], id: Union[int, None] = None) -> str:
+    message = f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n"
+    if id is not None:
+        message = f"id: {id}\n" + message
+    return message + "\n"
+
+
+@app.get("/history/{name}")
+async def history(name: str, response: Response, host: str = "", tier: str = "raw", start: float = 0, end: Union[float, None] = None):
+    """Player counts and ping latency (in ms) of a server over time, one array per column, from the oldest sample"""
+
+    resolutions = dict(TIERS)
+    if tier not in resolutions:
         response.status_code = status.HTTP_400_BAD_REQUEST
-        return {"error": f"Failed to find key {sort}"}
+        return {"error": f"Unknown tier {tier}, expected one of {', '.join(resolutions)}"}
+
+    found = poller.player_history.find(name, host)
+    if found is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"error": f"No history for server {name}"}
+
+    key, server_history = found
+    samples = server_history.tiers[tier].ring.range(start, end if end is not None else math.inf)
+    body = {"host": key.rpartition("/")[0], "name": name, "tier": tier, "resolution": resolutions[tier]}
+    body.update({column: samples[column] for column in Ring.COLUMNS})
+    return body
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/icons/{digest}.png")
+async def icon(request: Request, digest: str):
+    data = icon_cache.get(digest)
+    if data is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
+
+    # An icon's URL is the hash of its content, so it can be cached forever
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{digest}"'}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(data, media_type="image/png", headers=headers)
+
+
+async def ndjson_lines(servers: Sequence[Server], fields: Union[Tuple[str, ...], None]) -> AsyncIterator[bytes]:
+    # Every chunk goes through the whole middleware stack, so lines are sent in batches of about NDJSON_CHUNK_SIZE
+    chunk: List[bytes] = []
+    size = 0
+    for server in servers:
+        line = server.project(fields) if fields is not None else server.json_bytes
+        chunk.append(line)
+        size += len(line) + 1
+        if size >= NDJSON_CHUNK_SIZE:
+            yield b"\n".join(chunk) + b"\n"
+            chunk, size = [], 0
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON in request.headers.get("accept", "")
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Checks whether the request's If-None-Match header matches a given (strong) ETag"""
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = [x.strip().removeprefix("W/") for x in if_none_match.split(",")]
+    return etag in tags or "*" in tags
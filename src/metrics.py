@@ -0,0 +1,141 @@
+"""
+Description: Minimal in-process metrics, exposed in the Prometheus text format
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in zip(names, values)) + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return super().render() + [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in values]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, *labels: str, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+    def replace(self, values: Dict[Tuple[str, ...], float]):
+        """Replaces every value of the gauge at once, dropping the label sets which aren't given"""
+        with self._lock:
+            self._values = dict(values)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return super().render() + [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in values]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: the (non-cumulative) count for each bucket plus +Inf, then the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, *labels: str, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(k, list(counts), total[0]) for k, (counts, total) in self._values.items()]
+
+        lines = super().render()
+        names = self.label_names + ("le",)
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+PING_SECONDS = registry.register(Histogram("forgeserv_ping_seconds", "Round trip time of successful server list pings", ["container"]))
+PROBES = registry.register(Counter("forgeserv_probes_total", "Server statuses built from a ping or from the container's health check alone", ["source"]))
+PING_FAILURES = registry.register(Counter("forgeserv_ping_failures_total", "Failed server list pings", ["reason"]))
+DOCKER_SECONDS = registry.register(Histogram("forgeserv_docker_request_seconds", "Latency of Docker API calls", ["operation"]))
+REFRESH_SECONDS = registry.register(Histogram("forgeserv_refresh_seconds", "Duration of a full refresh of the server snapshot"))
+PARSE_LOG_SECONDS = registry.register(Histogram("forgeserv_parse_log_seconds", "Time spent parsing health check logs", buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001)))
+HTTP_SECONDS = registry.register(Histogram("forgeserv_http_request_seconds", "Latency of HTTP requests, including serialization", ["route"]))
+SINGLEFLIGHT_CALLS = registry.register(Counter("forgeserv_singleflight_calls_total", "Calls which started a computation (leader) or joined one in flight (coalesced)", ["flight", "result"]))
+CACHE_REQUESTS = registry.register(Counter("forgeserv_cache_requests_total", "Cache lookups", ["cache", "result"]))
+PLAYERS_ONLINE = registry.register(Gauge("forgeserv_players_online", "Players online per server", ["host", "server"]))
+PLAYERS_MAX = registry.register(Gauge("forgeserv_players_max", "Player slots per server", ["host", "server"]))
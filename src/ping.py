@@ -1,7 +1,27 @@
+import asyncio
 import base64
 import json
 import socket
 import struct
+import time
+
+from metrics import PING_FAILURES
+
+# Far above any real status response, even with a large modlist and favicon; the length prefix is
+#  untrusted, and could otherwise make us allocate up to 32 GiB
+MAX_PACKET_SIZE = 8 * 1024 * 1024
+
+
+class VarIntError(ValueError):
+    pass
+
+
+class PingError(Exception):
+    """A failed ping, along with the reason it failed (see failure_reason)"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
 
 
 class ServerPingResponse:
@@ -12,8 +32,11 @@ class ServerPingResponse:
 
         self.icon = base64.b64decode(data.get("favicon", "")[22:])
         self.players = Players(data["players"])
+        self.online = data["players"].get("online", len(self.players))
+        self.max = data["players"].get("max", 0)
         self.version = data["version"]["name"]
         self.protocol = data["version"]["protocol"]
+        self.latency = 0.0  # Round trip time of the ping, in seconds
 
     def __str__(self):
         return "Server(description={!r}, icon={!r}, version={!r}, protocol={!r}, players={})".format(self.description, bool(self.icon), self.version, self.protocol, self.players)
@@ -36,56 +59,240 @@ class Player:
         return self.name
 
 
-# For the rest of requests see wiki.vg/Protocol
-def ping(ip, port=25565):
-    def read_var_int():
-        i = 0
-        j = 0
+def handshake(ip, port):
+    host = ip.encode("utf-8")
+    data = b""  # wiki.vg/Server_List_Ping
+    data += b"\x00"  # packet ID
+    data += b"\x04"  # protocol variant
+    data += struct.pack(">b", len(host)) + host
+    data += struct.pack(">H", port)
+    data += b"\x01"  # next state
+    data = struct.pack(">b", len(data)) + data
+    return data + b"\x01\x00"  # handshake + status ping
+
+
+def decode_var_int(buf, offset=0):
+    """Decodes the VarInt starting at buf[offset]
+
+    Returns:
+        (value, offset just past the VarInt), or None if buf ends before the VarInt does
+    """
+    i = 0
+    for j in range(5):
+        if offset + j >= len(buf):
+            return None
+        k = buf[offset + j]
+        i |= (k & 0x7F) << (j * 7)
+        if not (k & 0x80):
+            return i, offset + j + 1
+    raise VarIntError("var_int too big")
+
+
+def check_packet_length(length):
+    if length > MAX_PACKET_SIZE:
+        raise ValueError(f"packet of {length} bytes, more than the {MAX_PACKET_SIZE} allowed")
+    return length
+
+
+class PacketReader:
+    """Reads VarInt length-prefixed packets off a socket
+
+    Small reads (i.e. VarInts) are served from a reusable head buffer, filled with recv_into, instead of
+    one recv(1) per byte. Packet bodies are received straight into a bytearray allocated once at their
+    final size, so large responses are never copied or concatenated along the way.
+    """
+
+    def __init__(self, sock, head_size=1024):
+        self.sock = sock
+        self._head = bytearray(head_size)
+        self._view = memoryview(self._head)
+        self._start = 0
+        self._end = 0
+
+    def _fill_head(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._head):
+            remaining = self._end - self._start
+            self._head[:remaining] = self._head[self._start : self._end]
+            self._start, self._end = 0, remaining
+
+        received = self.sock.recv_into(self._view[self._end :])
+        if not received:
+            raise ValueError("connection aborted")
+        self._end += received
+
+    def read_var_int(self):
         while True:
-            k = sock.recv(1)
-            if not k:
-                return 0
-            k = k[0]
-            i |= (k & 0x7F) << (j * 7)
-            j += 1
-            if j > 5:
-                raise ValueError("var_int too big")
-            if not (k & 0x80):
-                return i
+            decoded = decode_var_int(self._view[self._start : self._end])
+            if decoded is not None:
+                value, size = decoded
+                self._start += size
+                return value
+            self._fill_head()
+
+    def read_packet(self):
+        """Reads one full packet, returning it as a bytearray (without its length prefix)"""
+        length = check_packet_length(self.read_var_int())
+        packet = bytearray(length)
+        buffered = min(length, self._end - self._start)
+        packet[:buffered] = self._view[self._start : self._start + buffered]
+        self._start += buffered
+
+        with memoryview(packet) as view:
+            while buffered < length:
+                received = self.sock.recv_into(view[buffered:])
+                if not received:
+                    raise ValueError("connection aborted")
+                buffered += received
+        return packet
+
+
+class AsyncPacketReader:
+    """PacketReader's counterpart over an asyncio StreamReader
+
+    VarInts are decoded out of a reusable head buffer, filled with whatever the stream has buffered in one
+    read() call, instead of one readexactly(1) per byte. Packet bodies are copied chunk by chunk, as they
+    are read, into a bytearray allocated once at their final size, so they are never concatenated.
+    """
+
+    def __init__(self, reader, head_size=1024):
+        self.reader = reader
+        self._head = bytearray(head_size)
+        self._view = memoryview(self._head)
+        self._start = 0
+        self._end = 0
+
+    async def _fill_head(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._head):
+            remaining = self._end - self._start
+            self._head[:remaining] = self._head[self._start : self._end]
+            self._start, self._end = 0, remaining
+
+        chunk = await self.reader.read(len(self._head) - self._end)
+        if not chunk:
+            raise asyncio.IncompleteReadError(bytes(self._view[self._start : self._end]), None)
+        self._view[self._end : self._end + len(chunk)] = chunk
+        self._end += len(chunk)
 
+    async def read_var_int(self):
+        while True:
+            decoded = decode_var_int(self._view[self._start : self._end])
+            if decoded is not None:
+                value, size = decoded
+                self._start += size
+                return value
+            await self._fill_head()
+
+    async def read_packet(self):
+        """Reads one full packet, returning it as a bytearray (without its length prefix)"""
+        length = check_packet_length(await self.read_var_int())
+        packet = bytearray(length)
+        buffered = min(length, self._end - self._start)
+        packet[:buffered] = self._view[self._start : self._start + buffered]
+        self._start += buffered
+
+        with memoryview(packet) as view:
+            while buffered < length:
+                chunk = await self.reader.read(length - buffered)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(bytes(view[:buffered]), length)
+                view[buffered : buffered + len(chunk)] = chunk
+                buffered += len(chunk)
+        return packet
+
+
+def read_status(sock):
+    """Reads the status response packet off a socket which was sent a handshake + status ping
+
+    Returns:
+        dict: The decoded JSON status
+    """
+    return decode_status(PacketReader(sock).read_packet())
+
+
+async def read_status_async(reader):
+    """Asyncio equivalent of read_status, off a StreamReader"""
+    return decode_status(await AsyncPacketReader(reader).read_packet())
+
+
+def decode_status(packet):
+    """Decodes a status response packet: its type (0 for pings), then the length of its JSON string, then that string"""
+    if len(packet) < 10:
+        raise ValueError(f"invalid response {bytes(packet)}")
+
+    length, offset = decode_var_int(packet, 1) or (0, 0)
+    if len(packet) - offset != length:
+        raise ValueError("string length does not match packet length")
+
+    del packet[:offset]  # Trimming the front of a bytearray is O(1), no copy
+    return json.loads(packet)
+
+
+# For the rest of requests see wiki.vg/Protocol
+def ping(ip, port=25565):
     sock = socket.socket()
     sock.connect((ip, port))
     try:
-        host = ip.encode("utf-8")
-        data = b""  # wiki.vg/Server_List_Ping
-        data += b"\x00"  # packet ID
-        data += b"\x04"  # protocol variant
-        data += struct.pack(">b", len(host)) + host
-        data += struct.pack(">H", port)
-        data += b"\x01"  # next state
-        data = struct.pack(">b", len(data)) + data
-        sock.sendall(data + b"\x01\x00")  # handshake + status ping
-        length = read_var_int()  # full packet length
-        if length < 10:
-            if length < 0:
-                raise ValueError("negative length read")
-            else:
-                raise ValueError(f"invalid response {sock.read(length)}")  # type: ignore
-
-        sock.recv(1)  # packet type, 0 for pings
-        length = read_var_int()  # string length
-        data = b""
-        while len(data) != length:
-            chunk = sock.recv(length - len(data))
-            if not chunk:
-                raise ValueError("connection aborted")
-
-            data += chunk
+        sock.sendall(handshake(ip, port))
         try:
-            return ServerPingResponse(json.loads(data))
+            return ServerPingResponse(read_status(sock))
         except json.decoder.JSONDecodeError:
             return None
     except:
         return None
     finally:
         sock.close()
+
+
+async def ping_async(ip, port=25565, connect_timeout=3.0, read_timeout=5.0):
+    """Asyncio-native equivalent of ping(), bounded by a connect and a read timeout (in seconds)"""
+    try:
+        return await status_async(ip, port, connect_timeout, read_timeout)
+    except PingError:
+        return None
+
+
+async def status_async(ip, port=25565, connect_timeout=3.0, read_timeout=5.0):
+    """Same as ping_async, but raises a PingError telling why the ping failed instead of returning None"""
+
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), connect_timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        PING_FAILURES.inc(failure_reason(e))
+        raise PingError(failure_reason(e)) from e
+    except (ValueError, OverflowError) as e:  # A host name which can't be encoded (UnicodeError), or a port out of range
+        PING_FAILURES.inc("bad_target")
+        raise PingError("bad_target") from e
+
+    try:
+        writer.write(handshake(ip, port))
+        await writer.drain()
+        response = ServerPingResponse(await asyncio.wait_for(read_status_async(reader), read_timeout))
+        response.latency = time.perf_counter() - start
+        return response
+    except Exception as e:
+        PING_FAILURES.inc(failure_reason(e))
+        raise PingError(failure_reason(e)) from e
+    finally:
+        writer.close()
+
+
+def failure_reason(e: Exception) -> str:
+    """Classifies why a ping failed, for metrics and status reporting"""
+    if isinstance(e, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(e, ConnectionRefusedError):
+        return "refused"
+    if isinstance(e, asyncio.IncompleteReadError):
+        return "aborted"
+    if isinstance(e, OSError):
+        return "network"
+    if isinstance(e, VarIntError):
+        return "bad_varint"
+    if isinstance(e, json.JSONDecodeError):
+        return "bad_json"
+    return "bad_response"
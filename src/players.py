@@ -0,0 +1,114 @@
+"""
+Description: Inverted index from online players to the servers they're on
+
+Only the players a server lists in its ping response's sample are known, which most servers cap to
+a dozen or so, so large servers are only partially indexed.
+"""
+
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Set, Tuple
+
+from server import Player, Server, render_json
+
+
+class PlayerIndex:
+    """Players by UUID, and their (lowercased) names kept sorted for prefix searches
+
+    The index is updated incrementally after every refresh: only the servers whose record changed are
+    looked at, and each change to a server's players yields a "join" or "leave" event.
+    """
+
+    def __init__(self):
+        # The servers as last indexed, by key
+        self._servers: Dict[str, Server] = {}
+        # The servers each player is on, by UUID, as (host, server name) -> Player
+        self._by_uuid: Dict[str, Dict[Tuple[str, str], Player]] = {}
+        # The UUIDs going by each lowercased name, and those names in order
+        self._by_name: Dict[str, Set[str]] = {}
+        self._names: List[str] = []
+        self._online_json = b"[]"
+
+    def __len__(self) -> int:
+        return len(self._by_uuid)
+
+    def update(self, servers: Iterable[Server]) -> List[dict]:
+        """Indexes the players of the given servers, which replace all those indexed so far
+
+        Returns:
+            List[dict]: A "join" or "leave" event for every player who appeared on or left a server
+        """
+
+        servers = {x.key: x for x in servers}
+        events = []
+        for key in self._servers.keys() | servers.keys():
+            before, after = self._servers.get(key), servers.get(key)
+            if before is after:
+                continue  # Same record as last time, so the same players
+            old = set(before.players) if before is not None else set()
+            new = set(after.players) if after is not None else set()
+            server = after if after is not None else before
+            for player in old - new:
+                self._remove(player, server)  # type: ignore
+                events.append({"event": "leave", "data": self._location(player, server)})  # type: ignore
+            for player in new - old:
+                self._add(player, server)  # type: ignore
+                events.append({"event": "join", "data": self._location(player, server)})  # type: ignore
+
+        self._servers = servers
+        if events:
+            self._online_json = render_json(sorted(self._entries(self._by_uuid), key=lambda x: x["name"].lower()))
+        return events
+
+    def online_json(self) -> bytes:
+        """Every online player, with the servers they're on, as pre-rendered JSON"""
+        return self._online_json
+
+    def search(self, query: str) -> List[dict]:
+        """Finds the online players whose name starts with a prefix (ignoring case), or with a given UUID"""
+        if query in self._by_uuid:
+            return self._entries({query: self._by_uuid[query]})
+
+        prefix = query.lower()
+        uuids: Dict[str, Dict[Tuple[str, str], Player]] = {}
+        for name in self._names[bisect_left(self._names, prefix) :]:
+            if not name.startswith(prefix):
+                break
+            for uuid in self._by_name[name]:
+                uuids[uuid] = self._by_uuid[uuid]
+        return self._entries(uuids)
+
+    def _add(self, player: Player, server: Server):
+        self._by_uuid.setdefault(player.uuid, {})[(server.host, server.name)] = player
+        name = player.name.lower()
+        if name not in self._by_name:
+            self._by_name[name] = set()
+            insort(self._names, name)
+        self._by_name[name].add(player.uuid)
+
+    def _remove(self, player: Player, server: Server):
+        locations = self._by_uuid.get(player.uuid, {})
+        locations.pop((server.host, server.name), None)
+        if locations:
+            return
+        self._by_uuid.pop(player.uuid, None)
+        name = player.name.lower()
+        uuids = self._by_name.get(name, set())
+        uuids.discard(player.uuid)
+        if not uuids:
+            self._by_name.pop(name, None)
+            i = bisect_left(self._names, name)
+            if i < len(self._names) and self._names[i] == name:
+                del self._names[i]
+
+    @staticmethod
+    def _location(player: Player, server: Server) -> dict:
+        return {"name": player.name, "uuid": player.uuid, "host": server.host, "server": server.name}
+
+    @staticmethod
+    def _entries(uuids: Dict[str, Dict[Tuple[str, str], Player]]) -> List[dict]:
+        entries = []
+        for uuid, locations in uuids.items():
+            name = next(iter(locations.values())).name
+            servers = [{"host": host, "name": server} for host, server in locations]
+            entries.append({"name": name, "uuid": uuid, "servers": servers})
+        return entries
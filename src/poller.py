@@ -0,0 +1,473 @@
+"""
+Description: Background refresh of the server list into an in-memory snapshot
+"""
+
+import asyncio
+import dataclasses
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import partial
+from os import getenv
+from typing import Dict, List, Set, Tuple, Union
+
+from docker.models.containers import Container
+
+from broadcast import Broadcaster
+from common import probe_servers
+from history import HISTORY_FILE, HISTORY_SAVE_INTERVAL, PlayerHistory
+from hosts import DockerHost
+from icons import icon_cache, icon_digest
+from metrics import CACHE_REQUESTS, PLAYERS_MAX, PLAYERS_ONLINE, REFRESH_SECONDS
+from ping import PingError
+from players import PlayerIndex
+from scheduler import ProbeScheduler
+from server import Server, retain_preferred_ports, status_container_server_async
+from shared import SHARED_POLL_INTERVAL, SharedSnapshot, pack, unpack
+from singleflight import SingleFlight
+
+REFRESH_INTERVAL = float(getenv("REFRESH_INTERVAL", "10"))
+SNAPSHOT_MAX_AGE = float(getenv("SNAPSHOT_MAX_AGE", str(REFRESH_INTERVAL * 2)))
+SNAPSHOT_HISTORY = int(getenv("SNAPSHOT_HISTORY", "64"))
+# How long a worker without a snapshot waits for the leader to publish one before refreshing the servers itself
+SHARED_WAIT_TIMEOUT = float(getenv("SHARED_WAIT_TIMEOUT", str(SNAPSHOT_MAX_AGE)))
+
+logger = logging.getLogger(__name__)
+
+
+def _log_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Failed to refresh the server snapshot", exc_info=task.exception())
+
+
+def digest(data: Union[dict, list, str, bytes]) -> str:
+    """A stable digest of some JSON-serializable data"""
+    if isinstance(data, (dict, list)):
+        data = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha1(data).hexdigest()
+
+
+def _sort_key(value) -> tuple:
+    return (value is None, value if value is not None else "")
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    servers: Tuple[Server, ...]
+    generated_at: float
+    # Bumped only when the content changes, so equal versions always mean equal servers
+    version: int = 0
+    # Digest of each server's fields, by server key
+    digests: Dict[str, str] = field(default_factory=dict)
+    # Digest of the whole (ordered) server list
+    etag: str = ""
+    # The servers sorted by each key they were requested in, computed once per snapshot
+    orders: Dict[str, Tuple[Server, ...]] = field(default_factory=dict, compare=False, repr=False)
+
+    @property
+    def age(self) -> float:
+        return max(0.0, time.time() - self.generated_at)
+
+    def visible(self, all: bool = False) -> List[Server]:
+        """Gets the servers in this snapshot, optionally including the ones which aren't running"""
+        return list(self.servers) if all else [x for x in self.servers if x.status == "running"]
+
+    def sorted_by(self, key: str) -> Tuple[Server, ...]:
+        """Gets the servers in this snapshot ordered by one of their fields, missing values last"""
+        order = self.orders.get(key)
+        if order is None:
+            order = self.orders[key] = tuple(sorted(self.servers, key=lambda x: _sort_key(getattr(x, key))))
+        return order
+
+
+@dataclass(frozen=True)
+class Changes:
+    changed: List[Server]
+    removed: List[Dict[str, str]]
+
+
+class StatusPoller:
+    """Periodically rebuilds the list of servers (running or not) and swaps it in as a new Snapshot
+
+    The servers of every Docker host are refreshed concurrently, and a host taking longer than its refresh
+    timeout only has its own servers reported as unreachable. Each refresh only pings the servers which the
+    ProbeScheduler says are due, and reuses the last known status of the others. Readers only ever see a
+    complete Snapshot; a refresh builds the new one on the side and replaces the reference in a single
+    assignment once it is done. Every change between two snapshots is also published to the broadcaster,
+    as a "changed" event per added or updated server and a "removed" event per server which went away,
+    along with the "join" and "leave" events of the players index.
+
+    With a SharedSnapshot, only the elected process refreshes the snapshot (and follows the Docker hosts),
+    publishing each one it builds; the others adopt the published snapshots as they come instead. A process
+    which is still without a snapshot after SHARED_WAIT_TIMEOUT refreshes the servers itself rather than
+    keep its requests waiting, i.e. when the leader fails to publish; that local snapshot is version 0,
+    which is never published, so the leader's snapshots replace it as soon as one comes.
+    """
+
+    def __init__(
+        self,
+        hosts: List[DockerHost],
+        interval: float = REFRESH_INTERVAL,
+        max_age: float = SNAPSHOT_MAX_AGE,
+        shared: Union[SharedSnapshot, None] = None,
+    ):
+        self.hosts = hosts
+        self.shared = shared
+        self.broadcaster = Broadcaster()
+        self.scheduler = ProbeScheduler()
+        self.interval = interval
+        self.max_age = max_age
+        self.snapshot: Union[Snapshot, None] = None
+        self._history: "OrderedDict[int, Snapshot]" = OrderedDict()
+        self.player_history = PlayerHistory()
+        self.players = PlayerIndex()
+        # Round trip time of each server's latest successful ping, by server key
+        self._latencies: Dict[str, float] = {}
+        self._saved_at = time.monotonic()
+        self._refreshes = SingleFlight("refresh")
+        self._task: Union[asyncio.Task, None] = None
+        self._hosts_started = False
+        # The sequence numbers of the last shared snapshot and icons read, and the version and icons last published
+        self._sequence = 0
+        self._icons_sequence = 0
+        self._published = 0
+        self._published_icons: Union[Set[str], None] = None
+        self._ready = asyncio.Event()
+
+    @property
+    def leader(self) -> bool:
+        """Whether this process refreshes the snapshot itself, rather than adopting the shared one"""
+        return self.shared is None or self.shared.leader
+
+    async def refresh(self) -> Snapshot:
+        """Rebuilds the snapshot, joining the refresh already in progress if there is one
+
+        Returns:
+            Snapshot: The freshly built snapshot
+        """
+
+        return await self._refreshes.do(None, self._spawn_refresh)
+
+    def _spawn_refresh(self) -> "asyncio.Task[Snapshot]":
+        task = asyncio.create_task(self._refresh())
+        task.add_done_callback(_log_failure)
+        return task
+
+    async def _refresh(self, version: Union[int, None] = None) -> Snapshot:
+        containers = {x.name: x.inventory.containers(all=True) for x in self.hosts}
+        container_ids = {x.id for host_containers in containers.values() for x in host_containers}
+        self.scheduler.retain(container_ids)  # type: ignore
+        retain_preferred_ports(container_ids)  # type: ignore
+        with REFRESH_SECONDS.time():
+            per_host = await asyncio.gather(*(self._refresh_host(x, containers[x.name]) for x in self.hosts))
+        servers = [x for host_servers in per_host for x in host_servers]
+        if version == 0 and self.snapshot is not None:  # A local refresh, which the leader's snapshot beat
+            return self.snapshot
+        snapshot = self._swap(servers, time.time(), version)
+        if self.shared is not None and self.leader:
+            try:
+                self._publish(snapshot)
+            except ValueError:
+                logger.exception("Failed to publish the shared snapshot")
+        return snapshot
+
+    def _swap(
+        self,
+        servers: List[Server],
+        generated_at: float,
+        version: Union[int, None] = None,
+        digests: Union[Dict[str, str], None] = None,
+    ) -> Snapshot:
+        """Swaps in a new snapshot of the given servers, publishing the changes to the broadcaster
+
+        Args:
+            servers (List[Server]): The servers, as of the latest refresh
+            generated_at (float): The time of that refresh
+            version (Union[int, None]): The snapshot's version; if not given, the previous one, bumped if the servers changed
+            digests (Union[Dict[str, str], None]): The digest of each server, by key, if already known (i.e. published
+                along with the servers, which were then already deduplicated against the previous snapshot)
+        """
+
+        if digests is None:
+            # Keep the previous record of servers which didn't change, along with their already rendered JSON
+            known = {x.key: x for x in self.snapshot.servers} if self.snapshot is not None else {}
+            servers = [known[x.key] if known.get(x.key) == x else x for x in servers]
+            digests = {x.key: digest(x.json_bytes) for x in servers}
+
+        icon_cache.pin(icon_digest(x.icon) for x in servers if x.icon)
+        self._latencies = {x.key: self._latencies[x.key] for x in servers if x.key in self._latencies}
+        self.player_history.record(servers, self._latencies, generated_at)
+        PLAYERS_ONLINE.replace({(x.host, x.name): x.online for x in servers})
+        PLAYERS_MAX.replace({(x.host, x.name): x.max for x in servers})
+        etag = digest("".join(digests[x.key] for x in servers))
+
+        previous = self.snapshot
+        if version is None:
+            version = previous.version if previous is not None else 0
+            if previous is None or previous.version == 0 or previous.etag != etag:  # A local version 0 isn't published
+                version += 1
+
+        self.snapshot = Snapshot(servers=tuple(servers), generated_at=generated_at, version=version, digests=digests, etag=etag)
+        self._history[version] = self.snapshot
+        while len(self._history) > SNAPSHOT_HISTORY:
+            self._history.popitem(last=False)
+
+        if previous is not None and version != previous.version:
+            changes = self.changes(self.snapshot, previous.version, all=True)
+            for server in changes.changed if changes else []:
+                self.broadcaster.publish({"event": "changed", "version": version, "data": server.asdict()})
+            for removed in changes.removed if changes else []:
+                self.broadcaster.publish({"event": "removed", "version": version, "data": removed})
+        for event in self.players.update(servers):
+            self.broadcaster.publish({**event, "version": version})
+        self._ready.set()
+        return self.snapshot
+
+    def _publish(self, snapshot: Snapshot):
+        """Publishes a snapshot to the other processes, serializing it again only if its version changed
+
+        Each server is published as its already rendered JSON along with its digest, so that the other processes
+        only parse the servers which changed. The icons are published on the side, only when they change.
+        """
+
+        payload = None
+        if snapshot.version != self._published:
+            self._publish_icons(snapshot)
+            payload = pack(
+                {"servers": [[x.key, snapshot.digests[x.key]] for x in snapshot.servers], "latencies": self._latencies},
+                [x.json_bytes for x in snapshot.servers],
+            )
+        self.shared.publish(snapshot.version, snapshot.generated_at, payload)  # type: ignore
+        self._published = snapshot.version
+
+    def _publish_icons(self, snapshot: Snapshot):
+        linked = sorted({icon_digest(x.icon) for x in snapshot.servers if x.icon})
+        icons = {x: icon for x in linked if (icon := icon_cache.get(x)) is not None}
+        if icons.keys() == self._published_icons:
+            return
+        try:
+            payload = pack({"digests": list(icons)}, list(icons.values()))
+            self.shared.icons.publish(snapshot.version, snapshot.generated_at, payload)  # type: ignore
+        except ValueError:
+            logger.exception("Failed to publish the shared icons")
+            return
+        self._published_icons = set(icons)
+
+    def _adopt(self):
+        """Swaps in the snapshot last published by the leader, if it is a new one"""
+        known = self.snapshot.version if self.snapshot is not None else -1
+        published = self.shared.read(self._sequence, known, self._decode)  # type: ignore
+        if published is None:
+            return
+        self._sequence, version, generated_at, decoded = published
+        self._adopt_icons()  # Published before the snapshot, so they are there by now
+        if decoded is None:  # Refreshed without changes
+            self.snapshot = dataclasses.replace(self.snapshot, generated_at=generated_at)  # type: ignore
+            self.player_history.record(self.snapshot.servers, self._latencies, generated_at)
+        else:
+            servers, digests, self._latencies = decoded
+            self._swap(servers, generated_at, version, digests)
+
+    def _decode(self, payload: memoryview) -> Tuple[List[Server], Dict[str, str], Dict[str, float]]:
+        """Decodes a published snapshot, reusing the current record of the servers whose digest didn't change"""
+        index, fragments = unpack(payload)
+        known = {x.key: x for x in self.snapshot.servers} if self.snapshot is not None else {}
+        known_digests = self.snapshot.digests if self.snapshot is not None else {}
+        servers = []
+        digests = {}
+        for (key, server_digest), fragment in zip(index["servers"], fragments):
+            servers.append(known[key] if known_digests.get(key) == server_digest else Server.from_json(bytes(fragment)))
+            digests[key] = server_digest
+        return servers, digests, index["latencies"]
+
+    def _adopt_icons(self):
+        published = self.shared.icons.read(self._icons_sequence, decode=self._decode_icons)  # type: ignore
+        if published is not None:
+            self._icons_sequence, _, _, icons = published
+            for icon in icons:  # type: ignore
+                icon_cache.put(icon)
+
+    @staticmethod
+    def _decode_icons(payload: memoryview) -> List[bytes]:
+        """Copies the published icons which aren't cached yet"""
+        index, icons = unpack(payload)
+        return [bytes(icon) for x, icon in zip(index["digests"], icons) if icon_cache.get(x) is None]
+
+    async def _refresh_host(self, host: DockerHost, containers: List[Container]) -> List[Server]:
+        try:
+            return await asyncio.wait_for(probe_servers(containers, probe=partial(self._probe, host)), host.refresh_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Refreshing the servers of host %s timed out", host.name)
+            return [Server.unreachable(x, "host_timeout", self.scheduler.last_success(x), host=host.name) for x in containers]
+
+    async def _probe(self, host: DockerHost, container: Container) -> Server:
+        """Probes a container, reporting it as a bad container rather than failing the whole refresh if that raises"""
+        try:
+            return await self._probe_container(host, container)
+        except Exception:
+            logger.exception("Failed to probe container %s on host %s", container.name, host.name)
+            server = Server.unreachable(container, "bad_container", self.scheduler.last_success(container), host=host.name)
+            self.scheduler.failed(container, server, time.monotonic())
+            return server
+
+    async def _probe_container(self, host: DockerHost, container: Container) -> Server:
+        now = time.monotonic()
+        if not self.scheduler.due(container, now):
+            return self.scheduler.current(container)
+
+        last = self.scheduler.last_success(container)
+        if container.status != "running":
+            server = Server.unreachable(container, "not_running", last, host=host.name)
+            self.scheduler.parked(container, server)
+            return server
+
+        server = Server.from_health(container, time.time(), last, host=host.name)
+        if server is not None:
+            self.scheduler.succeeded(container, server, now)
+            return server
+
+        try:
+            ping_data = await status_container_server_async(container, host.ping_ip)
+        except PingError as e:
+            server = Server.unreachable(container, e.reason, last, host=host.name)
+            self.scheduler.failed(container, server, now)
+            return server
+
+        server = Server.from_ping(container, ping_data, host.name)
+        self._latencies[server.key] = ping_data.latency
+        self.scheduler.succeeded(container, server, now)
+        return server
+
+    def changes(self, snapshot: Snapshot, since: int, all: bool = False) -> Union[Changes, None]:
+        """Works out which servers changed between an earlier snapshot version and a given snapshot
+
+        Args:
+            snapshot (Snapshot): The snapshot to compare against the earlier version
+            since (int): The earlier snapshot version
+            all (bool): Whether to consider *all* servers, or just the running ones
+
+        Returns:
+            Union[Changes, None]: The servers added or changed and the host and name of those removed since that
+                version, or None if that version is unknown (too old, or from before a restart)
+        """
+
+        earlier = self._history.get(since)
+        if earlier is None or since > snapshot.version:
+            return None
+
+        before = {x.key: earlier.digests[x.key] for x in earlier.visible(all)}
+        after = {x.key: snapshot.digests[x.key] for x in snapshot.visible(all)}
+        return Changes(
+            changed=[x for x in snapshot.visible(all) if before.get(x.key) != after[x.key]],
+            removed=[{"host": x.host, "name": x.name} for x in earlier.visible(all) if x.key not in after],
+        )
+
+    async def get(self) -> Snapshot:
+        """Gets the current snapshot, following stale-while-revalidate semantics:
+        a snapshot older than max_age is still served, but triggers a refresh in the background
+
+        Returns:
+            Snapshot: The most recent snapshot, waiting on the very first refresh if none exists yet
+        """
+
+        snapshot = self.snapshot
+        if snapshot is None:
+            CACHE_REQUESTS.inc("snapshot", "miss")
+            if not self.leader:
+                try:
+                    await asyncio.wait_for(self._ready.wait(), SHARED_WAIT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return await self._refreshes.do("local", self._refresh_locally)
+                return self.snapshot  # type: ignore
+            return await self.refresh()
+        if snapshot.age > self.max_age:
+            CACHE_REQUESTS.inc("snapshot", "stale")
+            if self.leader and not self._refreshes.inflight(None):
+                self._refreshes.spawn(None, self._spawn_refresh)
+        else:
+            CACHE_REQUESTS.inc("snapshot", "hit")
+        return snapshot
+
+    async def _refresh_locally(self) -> Snapshot:
+        """Refreshes the servers in this process although another one leads, for want of a published snapshot"""
+        logger.warning("No shared snapshot was published within %ss, refreshing the servers locally", SHARED_WAIT_TIMEOUT)
+        await self._sync_hosts()
+        return await self._refresh(version=0)
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                pass  # Already logged by _log_failure, keep serving the previous snapshot
+            if time.monotonic() - self._saved_at >= HISTORY_SAVE_INTERVAL:
+                await self.save_history()
+            await asyncio.sleep(self.interval)
+
+    async def follow(self):
+        """Adopts the snapshots published by the leader, until this process gets elected leader itself"""
+        while True:
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+            if self.shared.try_lead():  # type: ignore
+                logger.info("Elected to refresh the shared snapshot")
+                await self._start_hosts()
+                await self.run()
+            try:
+                self._adopt()
+            except Exception:
+                logger.exception("Failed to read the shared snapshot")
+
+    async def save_history(self):
+        self._saved_at = time.monotonic()
+        if not HISTORY_FILE or not self.leader:
+            return
+        try:
+            await asyncio.to_thread(self.player_history.save, HISTORY_FILE, self.player_history.dump())
+        except OSError:
+            logger.exception("Failed to save the player history to %s", HISTORY_FILE)
+
+    async def _sync_hosts(self):
+        synced = await asyncio.gather(*(x.inventory.sync_async() for x in self.hosts), return_exceptions=True)
+        for host, result in zip(self.hosts, synced):
+            if isinstance(result, Exception):
+                logger.error("Failed to list the containers of host %s", host.name, exc_info=result)
+
+    async def _start_hosts(self):
+        # An unreachable host starts out empty, its inventory resyncs once its events stream can be followed
+        await self._sync_hosts()
+        for host in self.hosts:
+            host.inventory.start()
+        self._hosts_started = True
+
+    async def start(self):
+        """Starts refreshing the snapshot in the background, or following the shared one if another process does"""
+        if self._task is not None:
+            return
+        if HISTORY_FILE:
+            self.player_history.load(HISTORY_FILE)
+        if self.shared is not None:
+            self._adopt()  # Carry on from the last published snapshot (and version), even when elected
+        if self.leader or self.shared.try_lead():  # type: ignore
+            await self._start_hosts()
+            self._task = asyncio.create_task(self.run())
+        else:
+            self._task = asyncio.create_task(self.follow())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.save_history()
+        if self._hosts_started:
+            for host in self.hosts:
+                host.inventory.stop()
+            self._hosts_started = False
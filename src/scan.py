@@ -0,0 +1,192 @@
+"""
+Description: Bulk Server List Ping scanner, for Minecraft servers which aren't containers on this host
+
+Targets are host:port pairs, bare hosts or CIDR ranges (every host address of the range), the latter two
+being probed on each of the --ports. Results are written to stdout as NDJSON as they come in, and a
+summary with the throughput and latency percentiles to stderr at the end, i.e.
+
+    python scan.py play.example.com:25565 10.0.0.0/28 --ports 25565-25570 --rate 200 > results.ndjson
+    python scan.py -f partners.txt --retries 2
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import sys
+import time
+from collections import Counter
+from typing import Iterable, Iterator, List, Tuple, Union
+
+from ping import PingError, status_async
+
+# Failures worth another attempt, as opposed to a closed port or a server answering gibberish
+RETRY_REASONS = {"timeout", "aborted", "network"}
+RETRY_DELAY = 0.5
+
+
+def parse_ports(spec: str) -> List[int]:
+    """
+    Parses a list of ports
+    Arguments:
+        spec (str): comma separated ports and inclusive ranges, i.e. "25565,25570-25575"
+    Returns:
+        (List[int]) The ports, in order
+    """
+
+    ports = []
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        first, _, last = item.partition("-")
+        ports.extend(range(int(first), int(last or first) + 1))
+    return ports
+
+
+def expand_targets(specs: Iterable[str], ports: List[int]) -> Iterator[Tuple[str, Union[int, None]]]:
+    """
+    Expands target specifications into (host, port) pairs, lazily so huge ranges don't fill the memory
+    Arguments:
+        specs (Iterable[str]): host:port, [ipv6]:port, host, or CIDR range specifications
+        ports (List[int]): the ports to probe bare hosts and ranges on
+    Returns:
+        (Iterator[Tuple[str, Union[int, None]]]) The hosts and ports to probe, with a None port for invalid
+            specifications, which are reported rather than probed
+    """
+
+    for spec in filter(None, (x.strip() for x in specs)):
+        if spec.startswith("#"):
+            continue
+        if "/" in spec:
+            try:
+                network = ipaddress.ip_network(spec, strict=False)
+            except ValueError:
+                yield spec, None
+                continue
+            for address in network.hosts():
+                for port in ports:
+                    yield str(address), port
+            continue
+
+        host, colon, port = spec.rpartition(":")
+        if colon and port.isdigit() and (host.count(":") == 0 or host.endswith("]")):
+            yield host.strip("[]"), int(port)
+        else:
+            for port in ports:
+                yield spec.strip("[]"), port
+
+
+class RateLimiter:
+    """Spaces out the starts of probes to at most rate per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def probe(host: str, port: Union[int, None], args: argparse.Namespace, limiter: RateLimiter) -> dict:
+    """Pings a target, retrying transient failures, and describes the outcome as a result line"""
+
+    if port is None:
+        return {"host": host, "port": None, "ok": False, "error": "bad_target", "attempts": 0}
+    for attempt in range(1, args.retries + 2):
+        await limiter.wait()
+        try:
+            response = await status_async(host, port, args.connect_timeout, args.read_timeout)
+        except PingError as e:
+            if e.reason in RETRY_REASONS and attempt <= args.retries:
+                await asyncio.sleep(RETRY_DELAY * attempt)
+                continue
+            return {"host": host, "port": port, "ok": False, "error": e.reason, "attempts": attempt}
+
+        return {
+            "host": host,
+            "port": port,
+            "ok": True,
+            "latency_ms": round(response.latency * 1000, 2),
+            "version": response.version,
+            "protocol": response.protocol,
+            "online": response.online,
+            "max": response.max,
+            "players": [x.name for x in response.players],
+            "description": response.description,
+            "favicon": bool(response.icon),
+            "attempts": attempt,
+        }
+    raise AssertionError("unreachable")
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+
+async def scan(targets: Iterator[Tuple[str, Union[int, None]]], args: argparse.Namespace) -> dict:
+    """Probes every target with at most args.concurrency in flight, printing each result as it comes"""
+
+    limiter = RateLimiter(args.rate)
+    latencies: List[float] = []
+    outcomes: Counter = Counter()
+    start = time.perf_counter()
+
+    async def worker():
+        for host, port in targets:  # Shared iterator, so each target is taken by a single worker
+            result = await probe(host, port, args, limiter)
+            outcomes["ok" if result["ok"] else result["error"]] += 1
+            if result["ok"]:
+                latencies.append(result["latency_ms"])
+            sys.stdout.write(json.dumps(result, separators=(",", ":")) + "\n")
+            sys.stdout.flush()
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    probed = sum(outcomes.values())
+    return {
+        "targets": probed,
+        "ok": outcomes.pop("ok", 0),
+        "failures": dict(outcomes),
+        "seconds": round(elapsed, 3),
+        "targets_per_second": round(probed / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("targets", nargs="*", help="host:port, host or CIDR range to probe")
+    parser.add_argument("-f", "--file", action="append", default=[], help="file listing targets, one per line ('-' for stdin)")
+    parser.add_argument("--ports", type=parse_ports, default=[25565], help="ports to probe hosts and ranges on, i.e. 25565,25570-25575")
+    parser.add_argument("--concurrency", type=int, default=256, help="probes in flight at once")
+    parser.add_argument("--rate", type=float, default=0, help="probes started per second at most, 0 for no limit")
+    parser.add_argument("--connect-timeout", type=float, default=3.0, help="seconds to wait for a connection")
+    parser.add_argument("--read-timeout", type=float, default=5.0, help="seconds to wait for a status response")
+    parser.add_argument("--retries", type=int, default=1, help="extra attempts after a timeout or a network error")
+    args = parser.parse_args()
+
+    specs: List[str] = list(args.targets)
+    for path in args.file:
+        with sys.stdin if path == "-" else open(path) as f:
+            specs.extend(f.read().splitlines())
+    if not specs:
+        parser.error("no targets given")
+
+    summary = asyncio.run(scan(expand_targets(specs, args.ports), args))
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
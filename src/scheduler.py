@@ -0,0 +1,114 @@
+"""
+Description: Adaptive per-container probe scheduling, with backoff and circuit breaking for failing servers
+"""
+
+import math
+from dataclasses import dataclass
+from os import getenv
+from typing import Dict, Iterable, Tuple, Union
+
+from docker.models.containers import Container
+
+from server import Server, safe_get
+
+PROBE_INTERVAL_ACTIVE = float(getenv("PROBE_INTERVAL_ACTIVE", getenv("REFRESH_INTERVAL", "10")))
+PROBE_INTERVAL_IDLE = float(getenv("PROBE_INTERVAL_IDLE", "60"))
+PROBE_MAX_BACKOFF = float(getenv("PROBE_MAX_BACKOFF", "300"))
+BREAKER_THRESHOLD = int(getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(getenv("BREAKER_COOLDOWN", "600"))
+
+
+def fingerprint(container: Container) -> Tuple:
+    """
+    Sums up what, when it changes, makes a container due for a probe right away
+    The inventory re-reads containers after every health check run too, which mustn't cut a failing
+    server's backoff short, so the health log itself isn't part of it
+    Arguments:
+        container (Container): the container to sum up
+    Returns:
+        (Tuple) The container's state, start time, health status, name, image and labels
+    """
+
+    attrs = container.attrs
+    return (
+        safe_get(attrs, "State/Status"),
+        safe_get(attrs, "State/StartedAt"),
+        safe_get(attrs, "State/Health/Status"),
+        attrs.get("Name"),
+        safe_get(attrs, "Config/Image"),
+        tuple(sorted((safe_get(attrs, "Config/Labels") or {}).items())),
+    )
+
+
+@dataclass
+class ProbeState:
+    # The fingerprint of the container as it was when last probed
+    fingerprint: Tuple
+    # What to report for the server until its next probe
+    report: Server
+    # The server's status when it was last pinged successfully
+    last_success: Union[Server, None] = None
+    next_probe: float = 0.0
+    failures: int = 0
+
+
+class ProbeScheduler:
+    """Decides when each container's server should be pinged next
+
+    Servers with players online, or whose status just changed, are pinged every PROBE_INTERVAL_ACTIVE
+    seconds, idle ones every PROBE_INTERVAL_IDLE seconds. Failing servers are retried with exponential
+    backoff, and once they failed BREAKER_THRESHOLD times in a row their circuit opens: they are only
+    retried once every BREAKER_COOLDOWN seconds, and reported with their last known status until then.
+    Any change to a container's state, health status or configuration makes it due right away.
+    """
+
+    def __init__(
+        self,
+        active_interval: float = PROBE_INTERVAL_ACTIVE,
+        idle_interval: float = PROBE_INTERVAL_IDLE,
+        max_backoff: float = PROBE_MAX_BACKOFF,
+        breaker_threshold: int = BREAKER_THRESHOLD,
+        breaker_cooldown: float = BREAKER_COOLDOWN,
+    ):
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._states: Dict[str, ProbeState] = {}
+
+    def due(self, container: Container, now: float) -> bool:
+        state = self._states.get(container.id)  # type: ignore
+        return state is None or now >= state.next_probe or state.fingerprint != fingerprint(container)
+
+    def current(self, container: Container) -> Server:
+        """Gets what to report for a container which isn't due for a probe"""
+        return self._states[container.id].report  # type: ignore
+
+    def last_success(self, container: Container) -> Union[Server, None]:
+        state = self._states.get(container.id)  # type: ignore
+        return state.last_success if state is not None else None
+
+    def succeeded(self, container: Container, server: Server, now: float):
+        state = self._states.get(container.id)  # type: ignore
+        changed = state is None or state.report != server
+        interval = self.active_interval if changed or server.online > 0 else self.idle_interval
+        self._states[container.id] = ProbeState(fingerprint(container), server, server, now + interval)  # type: ignore
+
+    def failed(self, container: Container, server: Server, now: float):
+        state = self._states.get(container.id)  # type: ignore
+        failures = state.failures + 1 if state is not None else 1
+        if failures >= self.breaker_threshold:
+            delay = self.breaker_cooldown
+        else:
+            delay = min(self.active_interval * 2 ** (failures - 1), self.max_backoff)
+        self._states[container.id] = ProbeState(fingerprint(container), server, self.last_success(container), now + delay, failures)  # type: ignore
+
+    def parked(self, container: Container, server: Server):
+        """Records a server which can't be pinged until its container changes, i.e. a stopped one"""
+        self._states[container.id] = ProbeState(fingerprint(container), server, self.last_success(container), math.inf)  # type: ignore
+
+    def retain(self, container_ids: Iterable[str]):
+        """Forgets about all containers but the given ones"""
+        keep = set(container_ids)
+        self._states = {k: v for k, v in self._states.items() if k in keep}
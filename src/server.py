@@ -1,26 +1,61 @@
-import base64
+import asyncio
+import json
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from datetime import datetime
+from functools import lru_cache
 from os import getenv
-from typing import Any, List, Union
+from typing import Any, Dict, Iterable, List, Sequence, Set, Tuple, Union
 
 from docker.models.containers import Container
 
-from ping import ServerPingResponse
+from icons import icon_cache, icon_url
+from metrics import PARSE_LOG_SECONDS, PING_SECONDS, PROBES
+from ping import PingError, ServerPingResponse
 from ping import ping as ping_server
+from ping import status_async as status_server_async
 
 SPECIAL_CHAR = "§"
 DYNMAP_LABEL_KEY = "net.forgeserv.dynmap"
-
-
-@dataclass
+PING_CONNECT_TIMEOUT = float(getenv("PING_CONNECT_TIMEOUT", "3"))
+PING_READ_TIMEOUT = float(getenv("PING_READ_TIMEOUT", "5"))
+LOG_CACHE_SIZE = int(getenv("LOG_CACHE_SIZE", "1024"))
+# Distinct ?fields= projections whose renderings each server keeps
+PROJECTION_CACHE_SIZE = int(getenv("PROJECTION_CACHE_SIZE", "8"))
+PING_STAGGER = float(getenv("PING_STAGGER", "0.25"))
+# How recent the last health check must be for its output to stand in for a ping, 0 to always ping
+HEALTH_MAX_AGE = float(getenv("HEALTH_MAX_AGE", "0"))
+DEFAULT_PORT = "25565/tcp"
+
+LOG_KEY_PATTERN = re.compile(r"(?:^|\s)(\w+)=")
+# A formatting code is the section sign followed by a single code character
+FORMAT_CODE_PATTERN = re.compile(f"{SPECIAL_CHAR}.?", re.DOTALL)
+# Docker timestamps have nanoseconds, which datetime can't parse
+DOCKER_TIME_FRACTION_PATTERN = re.compile(r"(\.\d{6})\d*")
+
+
+@dataclass(frozen=True)
 class LogDerivedInfo:
     version: str = ""
+    online: int = 0
     max: int = 0
     motd: str = ""
 
 
-@dataclass
+LOG_FIELDS = {x.name for x in fields(LogDerivedInfo)}
+
+# The host port which last answered a ping, by container ID
+preferred_ports: Dict[str, int] = {}
+
+
+def retain_preferred_ports(container_ids: Iterable[str]):
+    """Forgets the preferred ports of all containers but the given ones"""
+    keep = set(container_ids)
+    for container_id in [x for x in preferred_ports if x not in keep]:
+        del preferred_ports[container_id]
+
+
+@dataclass(frozen=True)
 class Player:
     name: str
     uuid: str
@@ -39,6 +74,8 @@ class ServerConstructorParams:
     max: int
     players: List[Player]
     dynmap: Union[str, None]
+    error: Union[str, None] = None
+    host: str = ""
 
 
 def ping_container_server(container: Container) -> Union[ServerPingResponse, None]:
@@ -51,16 +88,128 @@ def ping_container_server(container: Container) -> Union[ServerPingResponse, Non
         Union[ServerPingResponse, None]: The info derived from the Ping, if available, otherwise None (failure case)
     """
 
+    for port in candidate_ports(container):
+        ping_data = ping_server(getenv("HOST_IP", "localhost"), port=port)
+        if ping_data:
+            preferred_ports[container.id] = port  # type: ignore
+            return ping_data
+    return None
+
+
+def candidate_ports(container: Container) -> List[int]:
+    """Lists the distinct host ports a container publishes over TCP, in the order they should be tried:
+    the port which last answered first, then the ones bound to the default Minecraft port, then the rest
+
+    Args:
+        container (Container): The container whose port bindings to list
+
+    Returns:
+        List[int]: The host ports
+    """
+
     # container.ports looks like {'25565/tcp': [{'HostIp': '0.0.0.0', 'HostPort': '25567'}, {'HostIp': '::', 'HostPort': '25567'}] }
-    #  we only want the host host IP and host port, so we can skip that and just look at the values and ignore the
-    #  "{port}/{tcp|udp}" part
-    for ip_port_pairs in container.ports.values():
-        for ip_port_pair in ip_port_pairs:
+    #  we only want the host port (we always ping HOST_IP), and the same host port is usually bound for IPv4 and IPv6
+    ports = []
+    for container_port, ip_port_pairs in sorted(container.ports.items(), key=lambda x: x[0] != DEFAULT_PORT):
+        if not container_port.endswith("/tcp"):
+            continue
+        for ip_port_pair in ip_port_pairs or []:
             try:
                 port = int(ip_port_pair["HostPort"])
-                return ping_server(getenv("HOST_IP", "localhost"), port=port)
-            except ValueError:
-                return None
+            except (KeyError, ValueError):
+                continue
+            if port not in ports:
+                ports.append(port)
+
+    preferred = preferred_ports.get(container.id)  # type: ignore
+    if preferred in ports:
+        ports.remove(preferred)
+        ports.insert(0, preferred)
+    return ports
+
+
+async def ping_container_server_async(container: Container) -> Union[ServerPingResponse, None]:
+    """Asyncio equivalent of ping_container_server, bounded by PING_CONNECT_TIMEOUT and PING_READ_TIMEOUT
+
+    Args:
+        container (Container): The container whose port bindings to try to ping
+
+    Returns:
+        Union[ServerPingResponse, None]: The info derived from the Ping, if available, otherwise None (failure case)
+    """
+
+    try:
+        return await status_container_server_async(container)
+    except PingError:
+        return None
+
+
+async def status_container_server_async(container: Container, ip: Union[str, None] = None) -> ServerPingResponse:
+    """Same as ping_container_server_async, but raises a PingError telling why the ping failed instead of returning None
+
+    All published ports are raced Happy Eyeballs style: the candidates are pinged concurrently, each
+    starting PING_STAGGER seconds after the previous one (or as soon as the previous one failed),
+    and the first valid response wins. The winning port is tried first next time.
+
+    Args:
+        container (Container): The container whose port bindings to try to ping
+        ip (Union[str, None]): The address of the container's host, HOST_IP if not given
+
+    Returns:
+        ServerPingResponse: The info derived from the Ping
+    """
+
+    ports = candidate_ports(container)
+    if not ports:
+        raise PingError("no_port")
+    PROBES.inc("ping")
+
+    async def attempt(port: int):
+        return port, await status_server_async(
+            ip or getenv("HOST_IP", "localhost"),
+            port=port,
+            connect_timeout=PING_CONNECT_TIMEOUT,
+            read_timeout=PING_READ_TIMEOUT,
+        )
+
+    pending: Set[asyncio.Task] = set()
+    error = PingError("no_port")
+    started = 0
+    try:
+        while True:
+            # Start on the next candidate: at first, once the previous ones had their head start, or as soon as one failed
+            if started < len(ports):
+                pending.add(asyncio.create_task(attempt(ports[started])))
+                started += 1
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=PING_STAGGER if started < len(ports) else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                try:
+                    port, ping_data = task.result()
+                except PingError as e:
+                    error = e
+                    continue
+                preferred_ports[container.id] = port  # type: ignore
+                PING_SECONDS.observe(container.name or container.id or "", value=ping_data.latency)
+                return ping_data
+    finally:
+        for task in pending:
+            task.cancel()
+    raise error
+
+
+def parse_docker_time(value: str) -> Union[float, None]:
+    """Parses an RFC 3339 timestamp from the Docker API into a unix timestamp, None if it can't be parsed"""
+    try:
+        return datetime.fromisoformat(DOCKER_TIME_FRACTION_PATTERN.sub(r"\1", value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
 
 
 def safe_get(d_in: dict, key: str) -> Any:
@@ -84,25 +233,108 @@ def safe_get(d_in: dict, key: str) -> Any:
     return subitem
 
 
+def render_json(data: Union[dict, list]) -> bytes:
+    """Renders JSON exactly the way FastAPI's JSONResponse does"""
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def render_servers(servers: Sequence["Server"], fields: Union[Tuple[str, ...], None] = None) -> bytes:
+    """Renders a JSON array of servers out of their cached renderings, or of only some of their fields"""
+    if fields is not None:
+        return b"[" + b",".join(x.project(fields) for x in servers) + b"]"
+    return b"[" + b",".join(x.json_bytes for x in servers) + b"]"
+
+
 class Server:
+    """An immutable server record, whose JSON rendering is computed once and then cached"""
+
+    __slots__ = ("health", "status", "type", "version", "icon", "motd", "name", "online", "max", "players", "dynmap", "error", "host", "_json", "_projections")
+    FIELDS = __slots__[:-2]
+
+    health: str
+    status: str
+    type: str
+    version: str
+    icon: Union[str, None]
+    motd: str
+    name: str
+    online: int
+    max: int
+    players: Tuple[Player, ...]
+    dynmap: Union[str, None]
+    # Why the server couldn't be pinged, in which case the other fields are its last known status
+    error: Union[str, None]
+    # The Docker host the server runs on
+    host: str
+
     def __init__(self, params: ServerConstructorParams):
-        self.health: str = params.health
-        self.status: str = params.status
-        self.type: str = params.type
-        self.version: str = params.version
-        self.icon: Union[str, None] = params.icon
-        self.motd: str = params.motd
-        self.name: str = params.name
-        self.online: int = params.online
-        self.max: int = params.max
-        self.players: List[Player] = params.players
-        self.dynmap: Union[str, None] = params.dynmap
+        for field in Server.FIELDS:
+            object.__setattr__(self, field, getattr(params, field))
+        object.__setattr__(self, "players", tuple(params.players))
+        object.__setattr__(self, "_json", None)
+        object.__setattr__(self, "_projections", None)
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Server) and self._values() == other._values()
+
+    def __hash__(self) -> int:
+        return hash(self._values())
+
+    @property
+    def key(self) -> str:
+        """Identifies the server across all Docker hosts"""
+        return f"{self.host}/{self.name}"
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, x) for x in Server.FIELDS)
+
+    @staticmethod
+    def from_dict(d: dict) -> "Server":
+        """Rebuilds a server out of its asdict()"""
+        params = ServerConstructorParams(**{x: d[x] for x in Server.FIELDS})
+        params.players = [Player(name=x["name"], uuid=x["uuid"]) for x in d["players"]]
+        return Server(params)
+
+    @staticmethod
+    def from_json(data: bytes) -> "Server":
+        """Rebuilds a server out of its json_bytes, which it keeps rather than rendering them again"""
+        server = Server.from_dict(json.loads(data))
+        object.__setattr__(server, "_json", data)
+        return server
+
+    def params(self) -> ServerConstructorParams:
+        return ServerConstructorParams(**{x: getattr(self, x) for x in Server.FIELDS})
 
     def asdict(self) -> dict:
-        d = self.__dict__
-        d["players"] = [x.__dict__ for x in self.players]
+        d = {x: getattr(self, x) for x in Server.FIELDS}
+        d["players"] = [{"name": x.name, "uuid": x.uuid} for x in self.players]
         return d
 
+    def project(self, fields: Tuple[str, ...]) -> bytes:
+        """Renders some of this server's fields as JSON, without even converting the others
+        The renderings of the last few projections are cached, like json_bytes"""
+        if fields == Server.FIELDS:
+            return self.json_bytes
+        rendered = self._projections.get(fields) if self._projections is not None else None
+        if rendered is None:
+            if self._projections is None or len(self._projections) >= PROJECTION_CACHE_SIZE:
+                object.__setattr__(self, "_projections", {})
+            d = {x: getattr(self, x) for x in fields}
+            if "players" in d:
+                d["players"] = [{"name": x.name, "uuid": x.uuid} for x in self.players]
+            rendered = self._projections[fields] = render_json(d)  # type: ignore
+        return rendered
+
+    @property
+    def json_bytes(self) -> bytes:
+        """This server's fields rendered as JSON, as it would appear in an API response"""
+        if self._json is None:
+            object.__setattr__(self, "_json", render_json(self.asdict()))
+        return self._json  # type: ignore
+
     @staticmethod
     def from_container(container: Container):
         """Attempts to build out a server instance from a given container
@@ -118,7 +350,137 @@ class Server:
         if not ping_data:
             return None
 
-        log_info = Server.parse_log_for_info(container.attrs["State"]["Health"]["Log"][-1]["Output"])
+        return Server.from_ping(container, ping_data)
+
+    @staticmethod
+    async def from_container_async(container: Container):
+        """Asyncio equivalent of from_container, which pings the server without blocking the event loop
+
+        Args:
+            container (Container): The container whose props should be analyzed
+
+        Returns:
+            Union[Server,None]: A server if parsing params was successful, None otherwise
+        """
+
+        try:
+            return await Server.probe(container)
+        except PingError:
+            return None
+
+    @staticmethod
+    async def probe(container: Container, ip: Union[str, None] = None, host: str = ""):
+        """Same as from_container_async, but raises a PingError telling why the ping failed instead of returning None
+
+        Args:
+            container (Container): The container whose props should be analyzed
+            ip (Union[str, None]): The address of the container's host, HOST_IP if not given
+            host (str): The name of the container's Docker host
+
+        Returns:
+            Server: The server described by the container and ping response
+        """
+
+        return Server.from_ping(container, await status_container_server_async(container, ip), host)
+
+    @staticmethod
+    def from_health(container: Container, now: float, last: Union["Server", None] = None, host: str = "", max_age: float = HEALTH_MAX_AGE):
+        """Builds out a server instance from the container's latest health check alone, without pinging it
+
+        The health check only tells the version, MOTD and player counts, so the favicon and player samples
+        are carried over from the last status, as long as the player count didn't change.
+
+        Args:
+            container (Container): The container whose props should be analyzed
+            now (float): The current unix timestamp
+            last (Union[Server, None]): The last status of the server, when it was last pinged successfully
+            host (str): The name of the container's Docker host
+            max_age (float): How old the health check may be, in seconds
+
+        Returns:
+            Union[Server, None]: The server, or None if it has to be pinged: its health check failed or is older
+                than max_age, or its favicon isn't known yet, or players joined or left
+        """
+
+        entry = (safe_get(container.attrs, "State/Health/Log") or [None])[-1]
+        if not max_age or last is None or not entry or entry.get("ExitCode") != 0:
+            return None
+        end = parse_docker_time(entry.get("End", ""))
+        if end is None or now - end > max_age:
+            return None
+        with PARSE_LOG_SECONDS.time():
+            log_info = Server.parse_log_for_info(entry.get("Output", ""))
+        if log_info.online != last.online:  # Both the real count, never the size of the player sample
+            return None
+
+        PROBES.inc("health")
+        params = last.params()
+        params.health = str(safe_get(container.attrs, "State/Health/Status"))
+        params.status = str(safe_get(container.attrs, "State/Status"))
+        params.version = log_info.version
+        params.motd = log_info.motd
+        params.max = log_info.max
+        params.error = None
+        params.host = host
+        return Server(params)
+
+    @staticmethod
+    def unreachable(container: Container, reason: str, last: Union["Server", None] = None, host: str = ""):
+        """Builds out a server instance for a container whose server couldn't be pinged
+
+        Args:
+            container (Container): The container whose props should be analyzed
+            reason (str): Why the server couldn't be pinged
+            last (Union[Server, None]): The last status of the server, when it was last pinged successfully
+            host (str): The name of the container's Docker host
+
+        Returns:
+            Server: The server's last known status (or what the container tells about it), with the error set
+        """
+
+        if last is not None:
+            params = last.params()
+            params.players = []
+        else:
+            health_log = safe_get(container.attrs, "State/Health/Log") or [{}]
+            log_info = Server.parse_log_for_info(health_log[-1].get("Output", ""))
+            params = ServerConstructorParams(
+                health="",
+                status="",
+                type=Server.get_server_type(list(safe_get(container.attrs, "Config/Env") or [])),
+                version=log_info.version,
+                icon=None,
+                motd=log_info.motd,
+                name=container.name or container.id or "",
+                online=0,
+                max=log_info.max,
+                players=[],
+                dynmap=container.labels.get(DYNMAP_LABEL_KEY),
+                host=host,
+            )
+        params.health = str(safe_get(container.attrs, "State/Health/Status"))
+        params.status = str(safe_get(container.attrs, "State/Status"))
+        params.online = 0
+        params.error = reason
+        return Server(params)
+
+    @staticmethod
+    def from_ping(container: Container, ping_data: ServerPingResponse, host: str = ""):
+        """Builds out a server instance from a given container and the result of pinging it
+
+        Args:
+            container (Container): The container whose props should be analyzed
+            ping_data (ServerPingResponse): The response from pinging the container's server
+            host (str): The name of the container's Docker host
+
+        Returns:
+            Server: The server described by the container and ping response
+        """
+
+        # The log is empty until the first health check ends, and missing without a healthcheck
+        health_log = safe_get(container.attrs, "State/Health/Log") or [{}]
+        with PARSE_LOG_SECONDS.time():
+            log_info = Server.parse_log_for_info(health_log[-1].get("Output", ""))
         players = [Player(name=pl.name, uuid=pl.id) for pl in ping_data.players]
         dynmap = container.labels[DYNMAP_LABEL_KEY] if DYNMAP_LABEL_KEY in container.labels else None
 
@@ -126,15 +488,16 @@ class Server:
             ServerConstructorParams(
                 health=str(safe_get(container.attrs, "State/Health/Status")),
                 status=str(safe_get(container.attrs, "State/Status")),
-                type=Server.get_server_type(list(safe_get(container.attrs, "Config/Env"))),
+                type=Server.get_server_type(list(safe_get(container.attrs, "Config/Env") or [])),
                 version=log_info.version,
-                icon=str(base64.b64encode(ping_data.icon).decode()) if ping_data.icon else None,
+                icon=icon_url(icon_cache.put(ping_data.icon)) if ping_data.icon else None,
                 motd=log_info.motd,
                 name=container.name or container.id or "",
-                online=len(players),
+                online=ping_data.online,  # The sample is capped (usually at 12 players), or hidden
                 max=log_info.max,
                 players=players,
                 dynmap=dynmap,
+                host=host,
             )
         )
 
@@ -155,42 +518,43 @@ class Server:
         return "Vanilla"
 
     @staticmethod
+    @lru_cache(maxsize=LOG_CACHE_SIZE)
     def parse_log_for_info(logs: str) -> LogDerivedInfo:
         """
         Gets the Game Version, MOTD, Online and Max Count from the server's log string
+        The health check output rarely changes between checks, so results are memoized on the raw string
         Arguments:
             log (str): the current log from this server
         Returns:
             (LogDerivedInfo): Info derived from the log lines.
         """
 
-        def __cleanup_motd(motd: str) -> str:
-            """Removes any color / format coding from a given MOTD"""
-            if SPECIAL_CHAR not in motd:
-                return motd
-            start = motd.index(SPECIAL_CHAR)
-            repl = motd[start : start + 2]
-            return __cleanup_motd(motd.replace(repl, ""))
-
         # We only care about the right half of the data after the :
-        _, logs = logs.split(" : ")
-        # Find all keys for the log line (universally)
-        keys: List[str] = re.findall("\w+(?=\=)", logs)
-        ret = LogDerivedInfo()
-
-        for idx, key in enumerate(keys):
-            start = logs.index(key) + len(f"{key}=")
-            end = len(logs) - 1
-            if key != keys[-1]:  # If we're NOT on the last key in the array, bump up
-                end = logs.index(keys[idx + 1])
-
-            value = logs[start:end].strip()
+        _, _, logs = logs.partition(" : ")
+        # Single pass over the "key=value key=value" pairs, where a value runs up to the next key.
+        #  The MOTD comes last and may contain anything (including "key=" lookalikes), so it takes the rest
+        values = {}
+        key, start = None, 0
+        for match in LOG_KEY_PATTERN.finditer(logs):
+            if key is not None:
+                values[key] = logs[start : match.start()]
+            key, start = match.group(1), match.end()
+            if key == "motd":
+                break
+        if key is not None:
+            values[key] = logs[start:]
+
+        parsed = {}
+        for key, value in values.items():
+            if key not in LOG_FIELDS:
+                continue
+            value = value.strip()
             try:
                 value = int(value)
             except ValueError:
                 pass
+            parsed[key] = value
 
-            ret.__dict__[key] = value
-
-        ret.motd = __cleanup_motd(ret.motd).replace('"', "").replace("'", "")
-        return ret
+        motd = FORMAT_CODE_PATTERN.sub("", str(parsed.get("motd", "")))
+        parsed["motd"] = motd.replace('"', "").replace("'", "")
+        return LogDerivedInfo(**parsed)
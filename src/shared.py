@@ -0,0 +1,173 @@
+"""
+Description: Sharing of the server snapshot between the worker processes of a single host
+
+Set the environment variable SHARED_SNAPSHOT to a path (ideally on a tmpfs, i.e. /dev/shm/forgeserv) when
+running several workers (fastapi run --workers N). The workers then elect a single one of them, through
+an exclusive lock on SHARED_SNAPSHOT.lock, to follow Docker and ping the servers; it publishes every
+snapshot it builds to the memory-mapped file, which the other workers read instead of polling the fleet
+themselves. Should the elected worker exit, its lock is released and another worker takes over.
+
+The icons the snapshot links to are published to SHARED_SNAPSHOT.icons, only when they change.
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+from os import getenv
+from typing import Callable, List, Tuple, TypeVar, Union
+
+SHARED_SNAPSHOT = getenv("SHARED_SNAPSHOT", "")
+SHARED_SNAPSHOT_SIZE = int(getenv("SHARED_SNAPSHOT_SIZE", str(16 * 1024 * 1024)))
+SHARED_POLL_INTERVAL = float(getenv("SHARED_POLL_INTERVAL", "0.5"))
+
+# sequence number, snapshot version, generation time, payload length
+HEADER = struct.Struct("<QQdQ")
+SEQUENCE = struct.Struct("<Q")
+INDEX_LENGTH = struct.Struct("<Q")
+READ_ATTEMPTS = 100
+
+T = TypeVar("T")
+
+
+def pack(index: dict, blobs: List[bytes]) -> bytes:
+    """Lays out a payload as a JSON index (to which the length of each blob is added), then the blobs"""
+    encoded = json.dumps({**index, "lengths": [len(x) for x in blobs]}, separators=(",", ":")).encode()
+    return INDEX_LENGTH.pack(len(encoded)) + encoded + b"".join(blobs)
+
+
+def unpack(payload: memoryview) -> Tuple[dict, List[memoryview]]:
+    """Splits a payload laid out by pack() into its index and views of its blobs, which aren't copied"""
+    (length,) = INDEX_LENGTH.unpack_from(payload, 0)
+    offset = INDEX_LENGTH.size + length
+    index = json.loads(bytes(payload[INDEX_LENGTH.size : offset]))
+    blobs = []
+    for size in index.pop("lengths"):
+        blobs.append(payload[offset : offset + size])
+        offset += size
+    return index, blobs
+
+
+class SharedRegion:
+    """A payload published by one process to any number of others, through a memory-mapped file
+
+    Writes are guarded by a seqlock: the writer makes the sequence number odd before touching the
+    payload and even again once done, and readers retry whenever the sequence number was odd or
+    changed while they were decoding the payload, so they never see a half-written one and never
+    block the writer.
+    """
+
+    def __init__(self, path: str, size: int = SHARED_SNAPSHOT_SIZE):
+        self.path = path
+        self.size = size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def sequence(self) -> int:
+        return SEQUENCE.unpack_from(self._mmap, 0)[0]
+
+    def publish(self, version: int, generated_at: float, payload: Union[bytes, None] = None):
+        """Publishes a payload
+
+        Args:
+            version (int): The version of the payload
+            generated_at (float): When the payload was built
+            payload (Union[bytes, None]): The payload, None to keep the one already published
+        """
+
+        if payload is not None and HEADER.size + len(payload) > self.size:
+            raise ValueError(f"{self.path} takes {len(payload)} bytes, more than SHARED_SNAPSHOT_SIZE allows")
+
+        # Odd while writing; a leader which died mid-write left it odd already
+        sequence = self.sequence() | 1
+        SEQUENCE.pack_into(self._mmap, 0, sequence)
+        length = HEADER.unpack_from(self._mmap, 0)[3]
+        if payload is not None:
+            length = len(payload)
+            self._mmap[HEADER.size : HEADER.size + length] = payload
+        HEADER.pack_into(self._mmap, 0, sequence, version, generated_at, length)
+        SEQUENCE.pack_into(self._mmap, 0, sequence + 1)
+
+    def read(
+        self, since: int = 0, known_version: int = -1, decode: Callable[[memoryview], T] = bytes  # type: ignore
+    ) -> Union[Tuple[int, int, float, Union[T, None]], None]:
+        """Reads the published payload, if it was published again since a given sequence number
+
+        Args:
+            since (int): The sequence number of the last payload read
+            known_version (int): The version whose payload the caller already has, so it needn't be decoded again
+            decode (Callable[[memoryview], T]): Decodes the payload straight out of the shared memory, by default
+                copying it; it must not keep the view it is given, and may be called again if the payload changed
+                while it was decoding it
+
+        Returns:
+            Union[Tuple[int, int, float, Union[T, None]], None]: The sequence number, version, generation time and
+                decoded payload (None if of the known version), or None if there is no new one (or it was being
+                written for too long)
+        """
+
+        for _ in range(READ_ATTEMPTS):
+            sequence, version, generated_at, length = HEADER.unpack_from(self._mmap, 0)
+            if sequence == since or sequence == 0:
+                return None
+            if sequence % 2:
+                continue
+            payload = None
+            if version != known_version:
+                try:
+                    with memoryview(self._mmap) as view, view[HEADER.size : HEADER.size + length] as region:
+                        payload = decode(region)
+                except Exception:
+                    if self.sequence() == sequence:
+                        raise
+                    continue  # Overwritten while decoding it
+            if self.sequence() == sequence:
+                return sequence, version, generated_at, payload
+        return None
+
+    def close(self):
+        self._mmap.close()
+
+
+class SharedSnapshot(SharedRegion):
+    """The snapshot published by the elected process, along with the icons it links to (in a region of their own)"""
+
+    def __init__(self, path: str, size: int = SHARED_SNAPSHOT_SIZE):
+        super().__init__(path, size)
+        self.icons = SharedRegion(path + ".icons", size)
+        self._lock_fd: Union[int, None] = None
+
+    @property
+    def leader(self) -> bool:
+        return self._lock_fd is not None
+
+    def try_lead(self) -> bool:
+        """Tries to become the process publishing snapshots, without waiting on the current one
+
+        Returns:
+            bool: Whether this process is (now) the leader
+        """
+
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def close(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)  # Releases the lock
+            self._lock_fd = None
+        self.icons.close()
+        super().close()
@@ -0,0 +1,51 @@
+"""
+Description: Coalescing of concurrent identical calls into a single in-flight one
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+from metrics import SINGLEFLIGHT_CALLS
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time: callers arriving while a call is in flight wait for it
+    and share its result (or exception) rather than starting their own
+
+    Every call is counted in SINGLEFLIGHT_CALLS, as "leader" if it started the computation and as
+    "coalesced" if it joined one already in flight.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def spawn(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> "asyncio.Task[T]":
+        """Gets the call in flight for a key, starting one with fn if there is none, without waiting for it"""
+        task = self._calls.get(key)
+        if task is not None:
+            SINGLEFLIGHT_CALLS.inc(self.name, "coalesced")
+            return task
+
+        SINGLEFLIGHT_CALLS.inc(self.name, "leader")
+        task = self._calls[key] = asyncio.ensure_future(fn())
+
+        def forget(_: asyncio.Task):
+            if self._calls.get(key) is task:
+                del self._calls[key]
+
+        task.add_done_callback(forget)
+        return task
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Waits for the result of the call in flight for a key, starting one with fn if there is none
+        A caller giving up (being cancelled) doesn't cancel the call, which the others may still be waiting on"""
+        return await asyncio.shield(self.spawn(key, fn))
+
+    def inflight(self, key: Hashable) -> bool:
+        return key in self._calls
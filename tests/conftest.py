@@ -0,0 +1,6 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "bench"))  # The fake Docker daemon, and the recorded attrs from test.py
+sys.path.insert(0, os.path.join(ROOT, "src"))
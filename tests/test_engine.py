@@ -0,0 +1,109 @@
+"""
+Description: Equivalence of the asyncio EngineClient with docker-py, both talking to a fake daemon socket
+built from the recorded attrs in test.py
+"""
+
+import asyncio
+import copy
+import time
+
+import pytest
+from docker import DockerClient
+from docker.errors import NotFound
+
+from common import get_container, get_container_async, list_containers, list_containers_async
+from engine import EngineClient
+from fakes import FakeEngine
+from fixtures import container_attrs
+from inventory import ContainerInventory
+
+
+def attrs_by_id(containers) -> dict:
+    return {x.id: x.attrs for x in containers if x is not None}
+
+
+@pytest.fixture
+def fake(tmp_path):
+    inspected = [container_attrs(i, 25565 + i, running=i != 3) for i in range(5)]
+    inspected[0]["Config"]["Labels"]["net.forgeserv.hidden"] = "true"
+    unrelated = container_attrs(5, 0)
+    unrelated["Config"]["Image"] = "ghcr.io/example/service:latest"
+    fake = FakeEngine(inspected + [unrelated], round_trip=0)
+    fake.start(str(tmp_path / "docker.sock"))
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def client(fake):
+    client = DockerClient(base_url=f"unix://{fake.path}")
+    yield client
+    client.close()
+
+
+async def with_engine(fake: FakeEngine, fn):
+    engine = EngineClient(fake.path)
+    try:
+        return await fn(engine)
+    finally:
+        engine.close()
+
+
+@pytest.mark.parametrize("all", [False, True])
+def test_listings_match(fake, client, all):
+    expected = attrs_by_id(list_containers(client, all=all))
+    assert expected  # Not vacuous
+    assert attrs_by_id(asyncio.run(with_engine(fake, lambda x: list_containers_async(x, all=all)))) == expected
+
+
+@pytest.mark.parametrize("name", ["server-1", "server-3", f"{1:064x}", "server-0", "server-5", "missing"])
+def test_lookups_match(fake, client, name):
+    expected = attrs_by_id([get_container(client, name)])
+    assert attrs_by_id([asyncio.run(with_engine(fake, lambda x: get_container_async(x, name)))]) == expected
+
+
+def test_missing_container_raises_not_found(fake):
+    with pytest.raises(NotFound):
+        asyncio.run(with_engine(fake, lambda x: x.inspect_container("missing")))
+
+
+def test_connections_are_reused(fake):
+    async def lookups(engine: EngineClient):
+        for _ in range(3):
+            await asyncio.gather(*(engine.inspect_container(f"server-{i}") for i in range(5)))
+
+    fake.connections = 0
+    asyncio.run(with_engine(fake, lookups))
+    assert fake.connections <= 5
+
+
+def test_inventories_match_after_events(fake, client):
+    async def follow(engine: EngineClient):
+        threaded, native = ContainerInventory(client), ContainerInventory(client, engine)
+        for inventory in (threaded, native):
+            await inventory.sync_async()
+            inventory.start()
+        await asyncio.sleep(0.2)  # Let both subscribe to the events
+
+        stopped = copy.deepcopy(fake.inspected[f"{1:064x}"])
+        stopped["State"].update(Status="exited", Running=False)
+        fake.update(stopped, "die")
+        hidden = copy.deepcopy(fake.inspected[f"{2:064x}"])
+        hidden["Config"]["Labels"]["net.forgeserv.hidden"] = "true"
+        fake.update(hidden, "update")
+
+        def caught_up(inventory: ContainerInventory) -> bool:
+            tracked = attrs_by_id(inventory.containers(all=True))
+            return tracked.get(stopped["Id"], {}).get("State", {}).get("Running") is False and hidden["Id"] not in tracked
+
+        deadline = time.monotonic() + 5
+        while not (caught_up(threaded) and caught_up(native)) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        for inventory in (threaded, native):
+            inventory.stop()
+        return threaded, native
+
+    threaded, native = asyncio.run(with_engine(fake, follow))
+    assert attrs_by_id(native.containers(all=True)) == attrs_by_id(threaded.containers(all=True))
+    assert f"{2:064x}" not in attrs_by_id(native.containers(all=True))
+    assert attrs_by_id(native.containers(all=True))[f"{1:064x}"]["State"]["Running"] is False